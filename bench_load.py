@@ -0,0 +1,49 @@
+import sys, os
+import time
+
+import numpy as np
+
+import tuw
+
+#Usage: python bench_load.py <dump> [max workers]
+#Times finding the packets in a dump, then decoding it with 1, 2, 4, ...
+#workers and checks that every parallel load matches the serial one.
+
+infile = sys.argv[1]
+max_workers = os.cpu_count()
+if len(sys.argv) > 2:
+    max_workers = int(sys.argv[2])
+
+def same(a, b):
+    for name, column in a.columns().items():
+        if not np.array_equal(column, getattr(b, name)):
+            return False
+    return (np.array_equal(a.room_code, b.room_code)
+        and a.room_names == b.room_names
+        and np.array_equal(a.offsets, b.offsets)
+        and np.array_equal(a.transients, b.transients)
+        and np.array_equal(a.flag_events, b.flag_events)
+        and a.flag_names == b.flag_names
+        and a.strings == b.strings)
+
+with open(infile, 'rb') as fp:
+    buf = fp.read()
+start_time = time.time()
+offsets, _, _ = tuw.table.scan_packets(buf)
+print(f'scan_packets: {time.time()-start_time:.2f} s for {len(offsets)} packets')
+del buf
+
+start_time = time.time()
+serial = tuw.StateTable(infile)
+serial_time = time.time()-start_time
+print(f'{len(serial)} states, {os.path.getsize(infile)/1e6:.1f} MB')
+print(f'1 worker: {serial_time:.2f} s')
+
+workers = 2
+while workers <= max_workers:
+    start_time = time.time()
+    table = tuw.StateTable(infile, workers=workers)
+    duration = time.time()-start_time
+    match = 'matches' if same(serial, table) else 'DOES NOT MATCH'
+    print(f'{workers} workers: {duration:.2f} s ({serial_time/duration:.2f}x), {match} serial')
+    workers *= 2
@@ -0,0 +1,19 @@
+import sys, os
+import time
+
+from tuw import catalog
+
+#Usage: python build_catalog.py <tuw_outputs directory> [catalog file]
+#Adds the runs of every new or changed dump in the directory to the run
+#catalog (by default tuw_catalog.sqlite in the same directory).
+
+directory = os.path.expanduser(sys.argv[1])
+path = catalog.catalog_path(directory)
+if len(sys.argv) > 2:
+    path = sys.argv[2]
+
+start_time = time.time()
+with catalog.Catalog(path) as cat:
+    count = cat.update(directory)
+    total = cat.db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+print(f'{count} files cataloged in {time.time()-start_time:.2f} s, {total} runs in {path}')
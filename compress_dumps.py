@@ -0,0 +1,24 @@
+import sys, os
+import time
+
+from tuw import archive
+
+#Usage: python compress_dumps.py <dump> [<dump> ...] [zlib|lzma|zstd]
+#Converts each dump to a compressed archive next to it (<dump>.tuwz), which
+#StateDump and the cut tools read in place of the dump.
+
+codec = None
+infiles = []
+for name in sys.argv[1:]:
+    if name in archive.CODECS.keys():
+        codec = name
+    else:
+        infiles.append(name)
+
+for infile in infiles:
+    start_time = time.time()
+    outfile = archive.compress_dump(infile, codec=codec)
+    duration = time.time()-start_time
+    size = os.path.getsize(infile)
+    archive_size = os.path.getsize(outfile)
+    print(f'{outfile}: {size/1e6:.1f} MB -> {archive_size/1e6:.1f} MB ({size/max(archive_size, 1):.1f}x) in {duration:.2f} s')
@@ -16,6 +16,7 @@ from proglog import ProgressBarLogger
 import tuw
 import tuw.cut_util
 import tuw.clusters
+import tuw.catalog
 
 
 class ProgressMachine(ProgressBarLogger):
@@ -219,6 +220,7 @@ sg.Button('Go', key='do_cut', enable_events=True),
 sg.Column(layout=[
     [sg.Button('Add files', key='add_files', enable_events=True)],
     [sg.Button('Sort', key='sort_files', enable_events=True)],
+    [sg.Button('Refresh', key='refresh_files', enable_events=True)],
 ]
 ),
 DListbox(key = 'infiles',
@@ -231,6 +233,21 @@ DListbox(key = 'infiles',
 
         return result
 
+    def get_catalog(self):
+        result = [
+sg.Text('Room'),
+sg.Input(key = 'catalog_room',
+    size = (10, 1),
+    ),
+sg.Text('Days'),
+sg.Input(key = 'catalog_days',
+    default_text = '30',
+    size = (5, 1),
+    ),
+sg.Button('Query catalog', key='query_catalog', enable_events=True),
+]
+        return result
+
     def get_clusters(self):
         result = [
     DListbox(
@@ -280,6 +297,7 @@ DListbox(key = 'infiles',
     def get_layout(self):
         self.get_progress_bar()
         return [[*self.get_inputs(), ],
+                [*self.get_catalog(), ],
                 [*self.get_config(), *self.get_extract(),],
                 [*self.get_clusters()],
                 [*self.get_output()],
@@ -289,6 +307,8 @@ DListbox(key = 'infiles',
 
 TUW_OUTPUTS = os.path.expanduser('~/.local/share/Steam/steamapps/common/Celeste/tuw_outputs')
 STAMP_FILE_PATH = '~/Videos/Streams'
+#tuw.clusters features runs are clustered on
+CLUSTER_FEATURES = tuw.clusters.DEFAULT_FEATURES
 
 class App():
     cluster_render_size = 420
@@ -391,10 +411,36 @@ class App():
 
         self.window['selected_runs'].update([x.death_count for x in export_runs])
 
+    def query_catalog(self):
+        """
+        Find runs across every dump in TUW_OUTPUTS through the run catalog
+        and load just those runs for export, instead of loading whole dumps.
+        Uses the room and days fields and the collection flags.
+        """
+        room = self.window['catalog_room'].get().strip()
+        if room == '':
+            room = None
+        try:
+            since = time.time()-float(self.window['catalog_days'].get())*86400
+        except ValueError:
+            since = None
+        collection = self.collection_flags if self.conditions['collection'] else 0
+
+        start_time = time.time()
+        with tuw.catalog.Catalog(tuw.catalog.catalog_path(TUW_OUTPUTS)) as catalog:
+            catalog.update(TUW_OUTPUTS)
+            rows = catalog.find_runs('ClipRun', room=room, collection=collection, since=since)
+            runs = catalog.load_runs(rows)
+        print(f'{len(runs)} runs loaded from the catalog in {time.time()-start_time:.2f} s')
+
+        self.export_runs = [tuw.cut_util.RunInclusion(idx, run, {'catalog'}) for idx, run in enumerate(runs)]
+        self.window['extract_counts'].update([['Total Runs', len(runs), len(runs)]])
+        self.window['selected_runs'].update([x.death_count for x in self.export_runs])
+
     def update_cluster_rooms(self):
         self.cluster_room_list = []
         for _, cut_input in self.input_map.items():
-            input_cms = cut_input.room_to_clusters.items()
+            input_cms = [(cut_input.room_name(room), cm) for room, cm in cut_input.room_to_clusters.items()]
             self.cluster_room_list.extend(input_cms)
 
         if len(self.cluster_room_list) == 0:
@@ -438,17 +484,22 @@ class App():
         self.window['cluster_runs'].update([x.states[0].deaths for x in runs])
         self.cluster_run_selection = None
 
-        sel_runs = self.window['selected_runs'].get_list_values()
+        sel_runs = set(self.window['selected_runs'].get_list_values())
         marks = [i for i,x  in enumerate(runs) if x.states[0].deaths in sel_runs]
         self.window['cluster_runs'].set_marked_items(marks)
 
-        centroid = tuw.clusters.get_centroid(cm.grp.clst, label)
+        centroid = cm.grp.get_centroid_features(label)
         def fmt_centroid(x):
-            return [
-                f'Length: {x[0]:.0f} px',
-                f'Start: {x[3]:.1f}, {x[4]:.1f}',
-                f'End: {x[1]:.1f}, {x[2]:.1f}',
-                ]
+            result = []
+            if 'length' in x:
+                result.append(f'Length: {x["length"]:.0f} px')
+            if 'duration' in x:
+                result.append(f'Duration: {x["duration"]:.2f} s')
+            if 'start_x' in x and 'start_y' in x:
+                result.append(f'Start: {x["start_x"]:.1f}, {x["start_y"]:.1f}')
+            if 'death_x' in x and 'death_y' in x:
+                result.append(f'End: {x["death_x"]:.1f}, {x["death_y"]:.1f}')
+            return result
 
 
         lines = []
@@ -511,13 +562,15 @@ class App():
             label = label[0]
 
             cm = self.cluster_room_list[self.cluster_room_selection][1]
-            _, end_x, end_y, start_x, start_y = tuw.clusters.get_centroid(cm.grp.clst, label)
+            centroid = cm.grp.get_centroid_features(label)
             def circle(x, y, s):
                 x = xoff+(x-xmin)*scale
                 y = yoff+(y-ymin)*scale
                 canvas.create_oval(x-s, y-s, x+s, y+s, fill='black')
-            circle(start_x, start_y, 4)
-            circle(end_x, end_y, 4)
+            if 'start_x' in centroid and 'start_y' in centroid:
+                circle(centroid['start_x'], centroid['start_y'], 4)
+            if 'death_x' in centroid and 'death_y' in centroid:
+                circle(centroid['death_x'], centroid['death_y'], 4)
 
         for idx, run in enumerate(self.cluster_run_list):
             if idx == run_idx: pass
@@ -569,9 +622,7 @@ class App():
         return files
 
     def update_flags(self):
-        self.flag_changes = tuw.FlagSet()
-        for infile, cut_input in self.input_map.items():
-            self.flag_changes.merge_into_self(cut_input.flag_changes)
+        self.flag_changes = tuw.cut_util.merge_flag_totals([x.flags for x in self.input_map.values()])
 
         rows = []
         for key, val in sorted(self.flag_changes.flags_changed.items(), key=lambda x: x[1]):
@@ -582,14 +633,24 @@ class App():
 
 
 
+    def load_progress(self, done, total, infile):
+        sg.one_line_progress_meter('Load progress', done, total, os.path.basename(infile), key='load_progress')
+
     def update_inputs(self):
-        for infile in self.window['infiles'].get_list_values():
-            if not infile in self.input_map.keys():
-                try:
-                    self.input_map[infile] = tuw.cut_util.CutInput(infile)
-                except Exception as e:
-                    print(f"Couldn't load {infile}: {e}")
-                    raise
+        infiles = [x for x in self.window['infiles'].get_list_values() if not x in self.input_map.keys()]
+        inputs = tuw.cut_util.load_inputs(infiles, progress=self.load_progress, features=CLUSTER_FEATURES)
+        self.input_map.update(zip(infiles, inputs))
+
+        self.update_flags()
+        self.extract()
+        self.update_cluster_rooms()
+
+    def refresh_inputs(self):
+        count = 0
+        for infile, cut_input in self.input_map.items():
+            count += cut_input.refresh()
+        if count == 0:
+            return
 
         self.update_flags()
         self.extract()
@@ -604,7 +665,7 @@ class App():
         self.extract()
 
     def add_files(self):
-        files = tkfb.askopenfilenames(initialdir = TUW_OUTPUTS, parent=self.window.TKroot, filetypes=[("*.dump", "*.dump"), ("All files","")])
+        files = tkfb.askopenfilenames(initialdir = TUW_OUTPUTS, parent=self.window.TKroot, filetypes=[("*.dump", "*.dump"), ("*.tuwz", "*.tuwz"), ("All files","")])
         if len(files) == 0:
             return
         files = self.sort_files(files)
@@ -663,6 +724,10 @@ class App():
                     self.do_cut()
                 elif event == 'sort_files':
                     self.sort_inputs()
+                elif event == 'refresh_files':
+                    self.refresh_inputs()
+                elif event == 'query_catalog':
+                    self.query_catalog()
                 elif event == 'selected_runs':
                     if 'listbox_up' in args:
                         self.window[event].scroll_selection(-1)
@@ -680,10 +745,10 @@ class App():
 
         window.close()
 
-sg.theme('SystemDefault 1')
-
-app = App()
-
-app.run()
+#inputs are loaded in new processes, which import this module
+if __name__ == '__main__':
+    sg.theme('SystemDefault 1')
 
+    app = App()
 
+    app.run()
@@ -5,30 +5,45 @@ import tuw
 from tuw import plots
 
 infile = sys.argv[1]
+
+room = None
+if len(sys.argv) > 2:
+    room = sys.argv[2]
+    if room == 'all': room = True
+
+#Stream the dump so the summary works on files bigger than memory; only the
+#runs being plotted are kept
+summary = {'states': 0, 'rooms': set(), 'strings': None}
+def summarize(states):
+    for state in states:
+        summary['states'] += 1
+        summary['rooms'].add(state.room)
+        if summary['strings'] is None:
+            summary['strings'] = state.strings
+        yield state
+
+plotter = None
+if room is not None:
+    plotter = plots.Plotter()
+
 start_time = time.time()
-states = tuw.StateDump(infile)
+run_count = 0
+for run in tuw.segment_states(summarize(tuw.iter_states(infile)), tuw.Run):
+    run_count += 1
+    if plotter is not None and (room is True or room in run.rooms):
+        plotter.plot(run)
 end_time = time.time()
 
-print(f'{len(states.states)} states loaded in {end_time-start_time:.2f} s')
-print(states.map)
-print(states.chapter)
-print(states.rooms)
+print(f'{summary["states"]} states loaded in {end_time-start_time:.2f} s')
+print(summary['strings'][1])
+print(summary['strings'][0])
+print(summary['rooms'])
 
-runs = states.extract_sequences(tuw.Run)
-print(f'{len(runs)} total runs')
+print(f'{run_count} total runs')
 
 #for run in runs:
 #    print(run.control_flags)
 
-if len(sys.argv) == 2: exit()
-room = sys.argv[2]
-if room == 'all': room = True
-
-plotter = plots.Plotter()
-
-
-for run in runs:
-    if room is True or room in run.rooms:
-        plotter.plot(run)
+if plotter is None: exit()
 
 plotter.show()
@@ -5,8 +5,18 @@ import tuw
 from tuw import render
 
 infile = sys.argv[1]
+
+room = None
+if len(sys.argv) > 2:
+    room = sys.argv[2]
+    if room == 'all': room = True
+
+#a single room only needs that room's packets
 start_time = time.time()
-states = tuw.StateDump(infile)
+if room is None or room is True:
+    states = tuw.StateDump(infile)
+else:
+    states = tuw.StateDump(infile, room=room)
 end_time = time.time()
 
 print(f'{len(states.states)} states loaded in {end_time-start_time:.2f} s')
@@ -20,9 +30,7 @@ print(f'{len(runs)} total runs')
 #for run in runs:
 #    print(run.control_flags)
 
-if len(sys.argv) == 2: exit()
-room = sys.argv[2]
-if room == 'all': room = True
+if room is None: exit()
 
 plotter = render.Plotter()
 
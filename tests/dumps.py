@@ -0,0 +1,85 @@
+import sys
+import types
+import struct
+
+import numpy as np
+
+import tuw
+from tuw.table import FIELDS
+
+#Synthetic dumps for the tests, written packet by packet in the mod's format
+
+HEADER = struct.Struct('=Idqi')
+PLAYER_INPUT = struct.Struct('=fffffffiiBB' 'BBff')
+
+ROOMS = ['a-00', 'a-01', 'b-02x', 'c-11']
+
+def write_dump(path, deaths, rooms, control, directions, transients = None):
+    """
+    Write a dump with one packet per entry of the arrays, rooms being
+    indices into ROOMS, and transients mapping a packet to (collection,
+    state_change)
+    """
+    if transients is None:
+        transients = {}
+    with open(path, 'wb') as fp:
+        for idx in range(len(deaths)):
+            payload = HEADER.pack(idx, 1000+idx/60, idx*166667, int(deaths[idx]))
+            payload += ROOMS[rooms[idx]].encode('ascii') + b'\x00'
+            payload += PLAYER_INPUT.pack(
+                float(idx % 97), float(-(idx % 53)), 1.0, -1.0, 110.0, 0.0, 0.0,
+                0, 1, int(control[idx]), 0,
+                0, int(directions[idx]), 0.0, 0.0)
+            if idx in transients:
+                payload += bytes([1, 2, *transients[idx]])
+            if idx == 0:
+                payload += b'Chapter\x00Map\x00'
+            fp.write(struct.pack('=H', len(payload)) + payload)
+
+def random_dump(path, seed, count = 3000, death_rate = 0.02, room_rate = 0.01, pause_rate = 0.02):
+    rng = np.random.default_rng(seed)
+    dead = rng.random(count) < death_rate
+    #death counts change on dead packets, and now and then on their own
+    deaths = np.cumsum(dead | (rng.random(count) < death_rate/4))
+    rooms = np.cumsum(rng.random(count) < room_rate) % len(ROOMS)
+    control = np.where(dead, tuw.CONTROL_DEAD, 0)
+    #pauses of a few packets, for ClipRun's segments
+    paused = np.zeros(count, bool)
+    toggles = rng.random(count)
+    for idx in range(1, count):
+        paused[idx] = toggles[idx] >= 0.2 if paused[idx-1] else toggles[idx] < pause_rate
+    control |= np.where(paused, tuw.CONTROL_PAUSED, 0)
+    #mark 3 (0x40 in the input byte) un-cuts ClipRun segments
+    directions = np.where(rng.random(count) < 0.005, 0x40, 0)
+    transients = {int(x): (int(rng.integers(1, 256)), int(rng.integers(1, 256)))
+        for x in np.flatnonzero(rng.random(count) < 0.01)}
+    write_dump(path, deaths, rooms, control, directions, transients)
+
+def check_table(result, expected):
+    """
+    Assert that two StateTables hold the same packets
+    """
+    assert len(result) == len(expected)
+    for name, _ in FIELDS:
+        assert np.array_equal(getattr(result, name), getattr(expected, name)), name
+    assert list(result.room) == list(expected.room)
+    assert np.array_equal(result.offsets, expected.offsets)
+    assert np.array_equal(result.transients, expected.transients)
+    assert result.flag_changes() == expected.flag_changes()
+    assert result.strings == expected.strings
+    assert result.end == expected.end
+
+def cut_util():
+    """
+    tuw.cut_util, with stand-ins for moviepy if it isn't installed. It is
+    only used to export video.
+    """
+    try:
+        import moviepy.editor
+    except ImportError:
+        moviepy = types.ModuleType('moviepy')
+        moviepy.editor = types.ModuleType('moviepy.editor')
+        sys.modules.setdefault('moviepy', moviepy)
+        sys.modules.setdefault('moviepy.editor', moviepy.editor)
+    from tuw import cut_util
+    return cut_util
@@ -0,0 +1,41 @@
+import os
+import zlib
+
+import pytest
+
+import tuw
+from tuw import archive
+
+from .dumps import random_dump, check_table
+
+#Checks that a dump written to an archive and read back matches the dump,
+#for each codec with and without delta encoding.
+
+@pytest.mark.parametrize('delta', [True, False])
+@pytest.mark.parametrize('codec', sorted(archive.CODECS))
+def test_round_trip(tmp_path, codec, delta):
+    if codec not in archive.available_codecs():
+        pytest.skip(f'{codec} is not installed')
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, 5)
+    table = tuw.StateTable(path, use_mmap=False)
+    output = path + archive.ARCHIVE_SUFFIX
+    archive.write_archive(table, output, codec, block_rows=700, delta=delta)
+    assert not os.path.exists(output + '.tmp')
+
+    check_table(archive.read_archive(output), table)
+    reader = archive.ArchiveReader(output)
+    assert len(reader.blocks) > 1
+    for start, stop in [(0, 10), (650, 760), (700, 1400), (1, len(table)-1), (2900, len(table))]:
+        check_table(reader.read(start, stop), table.slice(start, stop))
+
+def test_failed_write(tmp_path):
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, 6, count=100)
+    table = tuw.StateTable(path, use_mmap=False)
+    output = path + archive.ARCHIVE_SUFFIX
+    with pytest.raises(zlib.error):
+        #zlib levels only go up to 9
+        archive.write_archive(table, output, 'zlib', level=20)
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + '.tmp')
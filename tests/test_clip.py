@@ -0,0 +1,57 @@
+import tuw
+from tuw.tuw import GameState, segment_states, segment_table
+
+from .dumps import write_dump, random_dump, cut_util
+
+#Checks that clip_segments cuts runs the same way as ClipRun.get_segments
+#does on a list of states.
+
+#one run per string: . live, P paused, M mark 3, m mark 3 while paused,
+#D dead, X dead while paused
+RUNS = [
+    '....D',
+    '....PPP....D',
+    'PPP......D',
+    'PPPD',
+    '......PPPX',
+    'PPPPPX',
+    'P.P.P.P.D',
+    '..PP..PP..D',
+    '..PPmP...D',
+    '..M..PP..D',
+    '..PP..M.PP..D',
+    'mPP..PP.MD',
+    'PP..PP..X',
+    ]
+
+def pattern_dump(path):
+    control, directions, deaths = [], [], []
+    for death, run in enumerate(RUNS):
+        for char in run:
+            control.append((tuw.CONTROL_PAUSED if char in 'PmX' else 0) |
+                (tuw.CONTROL_DEAD if char in 'DX' else 0))
+            directions.append(0x40 if char in 'Mm' else 0)
+            deaths.append(death)
+    write_dump(path, deaths, [0]*len(deaths), control, directions)
+
+def check_segments(table):
+    ClipRun = cut_util().ClipRun
+    expected = [x.get_segments() for x in segment_states(GameState.iter_table(table), ClipRun)]
+    runs = segment_table(table, ClipRun)
+    assert all(isinstance(x.states, tuw.StateList) for x in runs)
+    assert [x.get_segments() for x in runs] == expected
+    assert cut_util().run_segments(runs) == expected
+    return expected
+
+def test_pause_patterns(tmp_path):
+    path = str(tmp_path / 'pattern.dump')
+    pattern_dump(path)
+    expected = check_segments(tuw.StateTable(path, use_mmap=False))
+    assert len(expected) == len(RUNS)
+    assert any(len(x) > 1 for x in expected)
+
+def test_random_pauses(tmp_path):
+    for seed in range(3):
+        path = str(tmp_path / f'random{seed}.dump')
+        random_dump(path, seed, death_rate=0.03, pause_rate=0.05)
+        check_segments(tuw.StateTable(path, use_mmap=False))
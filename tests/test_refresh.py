@@ -0,0 +1,51 @@
+import numpy as np
+
+import tuw
+
+from .dumps import random_dump, check_table
+
+#Checks that refreshing a dump as it is written gives the same table and
+#runs as loading it whole, and that a rewritten dump is loaded again.
+
+def grow(path, data, stops):
+    #write data to path in pieces ending at each of stops, yielding after each
+    with open(path, 'wb') as fp:
+        for stop in stops:
+            fp.write(data[fp.tell():stop])
+            fp.flush()
+            yield stop
+
+def test_growing_dump(tmp_path):
+    full = str(tmp_path / 'full.dump')
+    random_dump(full, 7)
+    with open(full, 'rb') as fp:
+        data = fp.read()
+    expected = tuw.StateTable(full, use_mmap=False)
+
+    path = str(tmp_path / 'growing.dump')
+    #cut mid packet now and then, the partial packet waits for the next refresh
+    stops = sorted(set(np.random.default_rng(7).integers(1, len(data), 40).tolist())) + [len(data)]
+    pieces = grow(path, data, stops)
+    next(pieces)
+    states = tuw.StateDump(path, cache=False)
+    runs = states.follow(tuw.Run)
+    for stop in pieces:
+        states.refresh()
+        assert states.table.end <= stop
+    check_table(states.table, expected)
+    assert [x.row_range() for x in runs] == [x.row_range() for x in tuw.StateDump(full, cache=False).extract_sequences(tuw.Run)]
+
+def test_rewritten_dump(tmp_path):
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, 8)
+    states = tuw.StateDump(path, cache=False)
+    runs = states.follow(tuw.Run)
+    old = [x.row_range() for x in runs]
+
+    for seed, count in [(9, 3000), (10, 3500), (11, 2000)]:
+        random_dump(path, seed, count, death_rate=0.05)
+        assert states.refresh() == len(states.table)
+        check_table(states.table, tuw.StateTable(path, use_mmap=False))
+        assert [x.row_range() for x in runs] == [x.row_range() for x in tuw.StateDump(path, cache=False).extract_sequences(tuw.Run)]
+        assert [x.row_range() for x in runs] != old
+        old = [x.row_range() for x in runs]
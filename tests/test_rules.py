@@ -0,0 +1,79 @@
+import pytest
+
+import tuw
+from tuw import rules
+from tuw.tuw import GameState, segment_states, segment_table
+
+from .dumps import random_dump
+
+#Checks that RuleSequence.segment_rows finds the same sequences as feeding
+#every packet to add_state, on small synthetic dumps.
+
+dead = rules.flag('control_flags', tuw.CONTROL_DEAD)
+paused = rules.flag('control_flags', tuw.CONTROL_PAUSED)
+
+class BeginOnly(rules.RuleSequence):
+    #starts at the first packet left of x 10 and never ends
+    begin = rules.field('xpos') < 10
+
+class EndOnly(rules.RuleSequence):
+    end = dead
+
+class BeginEnd(rules.RuleSequence):
+    begin = rules.field('xpos') > 50
+    end = dead | (rules.field('ypos') == -40)
+
+class Split(rules.RuleSequence):
+    end = dead
+    split = rules.changed('room') | rules.changed('deaths')
+
+class RequireExclude(rules.RuleSequence):
+    end = dead
+    split = rules.changed('room')
+    min_states = 5
+    require = rules.field('xpos') > 80
+    exclude = paused & (rules.field('ypos') < -30)
+
+class Trailing(rules.RuleSequence):
+    #ends at a pause and takes the rest of it along
+    end = paused
+    trailing = paused
+    split = rules.field('room').isin(['c-11']) & rules.changed('room')
+
+RULES = [BeginOnly, EndOnly, BeginEnd, Split, RequireExclude, Trailing]
+
+def describe(seq):
+    return (seq.row_range(), len(seq.states), seq.done, seq.valid(),
+        seq.room_order, seq.control, seq.collection, seq.state_change,
+        seq.death_state_index, seq.ending)
+
+@pytest.mark.parametrize('Rule', RULES, ids=[x.__name__ for x in RULES])
+@pytest.mark.parametrize('seed, death_rate, room_rate', [
+    (1, 0.02, 0.01),
+    (2, 0.2, 0.05),
+    (3, 0.05, 0.3),
+    ])
+def test_rule_segments(tmp_path, Rule, seed, death_rate, room_rate):
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, seed, death_rate=death_rate, room_rate=room_rate)
+    table = tuw.StateTable(path, use_mmap=False)
+    for start, stop in [(0, len(table)), (11, len(table)//2), (len(table)//3, len(table)-3)]:
+        expected = [describe(x) for x in
+            segment_states(GameState.iter_table(table, start, stop), Rule)]
+        result = [describe(x) for x in segment_table(table, Rule, start, stop)]
+        assert len(expected) > 0
+        assert result == expected, (start, stop)
+
+def test_trailing_unfinished(tmp_path):
+    #the table stops inside the pause that ends the last sequence
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, 1)
+    table = tuw.StateTable(path, use_mmap=False)
+    is_paused = table.control_flags & tuw.CONTROL_PAUSED != 0
+    stop = next(x for x in range(3, len(table)) if is_paused[x-3:x+1].all())
+
+    expected = [describe(x) for x in segment_states(GameState.iter_table(table, 0, stop), Trailing)]
+    result = [describe(x) for x in segment_table(table, Trailing, 0, stop)]
+    assert result == expected
+    done, ending = result[-1][2], result[-1][-1]
+    assert not done and ending
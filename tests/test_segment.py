@@ -0,0 +1,95 @@
+import functools
+
+import pytest
+
+import tuw
+from tuw.tuw import GameState, segment_states, segment_table
+
+from .dumps import ROOMS, write_dump, random_dump, cut_util
+
+#Checks that segmenting a table from its columns (segment_rows) finds the
+#same runs as feeding every packet to add_state, on small synthetic dumps.
+#Run with python -m pytest tests
+
+def parity_dump(path):
+    """
+    Runs of 1 to 5 packets in a row that each change room or death count,
+    after both a dead packet and a live one. RoomRun ignores a change on the
+    first packet of a run, so every other one of these ends a run.
+    """
+    deaths, rooms, control = [], [], []
+    death, room = 0, 0
+    for length in range(1, 6):
+        for after_dead in (False, True):
+            for kind in ('room', 'deaths', 'both'):
+                for _ in range(4):
+                    deaths.append(death)
+                    rooms.append(room)
+                    control.append(0)
+                control[-1] = tuw.CONTROL_DEAD if after_dead else 0
+                for _ in range(length):
+                    if kind != 'deaths':
+                        room = (room+1) % len(ROOMS)
+                    if kind != 'room':
+                        death += 1
+                    deaths.append(death)
+                    rooms.append(room)
+                    control.append(0)
+    write_dump(path, deaths, rooms, control, [0]*len(deaths))
+
+def describe(run):
+    result = (run.row_range(), len(run.states), run.done, run.valid(),
+        run.room_order, run.rooms, run.control, run.collection,
+        run.state_change, run.mark_flags, run.death_state_index,
+        getattr(run, 'ending', None))
+    if hasattr(run, 'get_segments'):
+        result += (run.get_segments(),)
+    return result
+
+CLASSES = ['Run', 'RoomRun', 'RoomCompleteRun', 'ClipRun']
+
+def run_class(name):
+    if name == 'ClipRun':
+        return cut_util().ClipRun
+    return getattr(tuw, name)
+
+def check_table(table, SequenceClass):
+    for start, stop in [(0, len(table)), (7, len(table)//2), (len(table)//3, len(table)-5)]:
+        expected = [describe(x) for x in
+            segment_states(GameState.iter_table(table, start, stop), SequenceClass)]
+        result = [describe(x) for x in segment_table(table, SequenceClass, start, stop)]
+        assert len(expected) > 0
+        assert result == expected, (start, stop)
+
+@pytest.mark.parametrize('name', CLASSES)
+@pytest.mark.parametrize('seed, death_rate, room_rate', [
+    (1, 0.02, 0.01),
+    (2, 0.2, 0.05),
+    (3, 0.5, 0.3),
+    (4, 0.05, 0.5),
+    ])
+def test_random_dump(tmp_path, name, seed, death_rate, room_rate):
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, seed, death_rate=death_rate, room_rate=room_rate)
+    check_table(tuw.StateTable(path, use_mmap=False), run_class(name))
+
+@pytest.mark.parametrize('name', CLASSES)
+def test_change_parity(tmp_path, name):
+    path = str(tmp_path / 'parity.dump')
+    parity_dump(path)
+    check_table(tuw.StateTable(path, use_mmap=False), run_class(name))
+
+@pytest.mark.parametrize('archived', [False, True])
+def test_streamed_rows(tmp_path, monkeypatch, archived):
+    #read in many small blocks, runs still get rows of the whole dump
+    path = str(tmp_path / 'random.dump')
+    random_dump(path, 5, death_rate=0.05)
+    table = tuw.StateTable(path, use_mmap=False)
+    if archived:
+        path += tuw.archive.ARCHIVE_SUFFIX
+        tuw.archive.write_archive(table, path, 'zlib', block_rows=300)
+    else:
+        monkeypatch.setattr(tuw.tuw, 'iter_tables', functools.partial(tuw.table.iter_tables, block_size=0x2000))
+    expected = [x.row_range() for x in segment_table(table, tuw.Run)]
+    assert [x.index for x in tuw.iter_states(path)] == list(range(len(table)))
+    assert [x.row_range() for x in tuw.iter_sequences(path, tuw.Run)] == expected
@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import zlib
+import lzma
+import bisect
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .table import StateTable, FIELDS, ROOM_CODE, TRANSIENT_DTYPE, FLAG_DTYPE
+from .cache import _pairs
+
+#Compressed archive of a decoded dump. The table is cut into blocks of rows
+#and each block is compressed on its own, so blocks can be decompressed in
+#parallel or read individually through the block index.
+#
+#File layout:
+#   MAGIC, version byte
+#   blocks
+#   json index: names, strings, block offsets/sizes/rows/timestamps
+#   footer: index offset (uint64), MAGIC
+#
+#A block holds each column of its rows end to end, followed by room_code,
+#offsets and the block's transient and flag events (with packet indices
+#relative to the block). Columns that change slowly are stored as
+#differences from the previous row, taken on the raw bits so floats round
+#trip exactly; this is what lets them compress well.
+
+MAGIC = b'TUWZ'
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = '.tuwz'
+FOOTER = struct.Struct('=Q4s')
+
+BLOCK_ROWS = 0x10000
+#decompressed blocks an ArchiveReader keeps around for nearby reads
+CACHED_BLOCKS = 4
+
+DELTA_FIELDS = {'sequence', 'timestamp', 'time', 'xpos', 'ypos'}
+
+_UINT = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}
+
+def _compress_zstd(data, level = None):
+    return zstandard.ZstdCompressor(level=9 if level is None else level).compress(data)
+
+def _decompress_zstd(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+CODECS = {
+    'zlib': (lambda x, level=None: zlib.compress(x, 6 if level is None else level), zlib.decompress),
+    'lzma': (lambda x, level=None: lzma.compress(x, preset=6 if level is None else level), lzma.decompress),
+    'zstd': (_compress_zstd, _decompress_zstd),
+    }
+
+def available_codecs():
+    return [x for x in CODECS.keys() if x != 'zstd' or zstandard is not None]
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+def _delta(column):
+    #wrapping integer differences of the raw bits
+    bits = column.view(_UINT[column.dtype.itemsize])
+    result = bits.copy()
+    result[1:] -= bits[:-1]
+    return result
+
+def _undelta(data, dtype):
+    dtype = np.dtype(dtype)
+    bits = np.cumsum(data.view(_UINT[dtype.itemsize]), dtype=_UINT[dtype.itemsize])
+    return bits.view(dtype)
+
+def _block_columns(delta_fields = DELTA_FIELDS):
+    #(name, dtype, delta encoded) in block order
+    result = [(name, np.dtype(dtype), name in delta_fields) for name, dtype in FIELDS]
+    result.append(('room_code', np.dtype(ROOM_CODE), False))
+    result.append(('offsets', np.dtype(np.int64), True))
+    return result
+
+def is_archive(filename):
+    try:
+        with open(filename, 'rb') as fp:
+            return fp.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def write_archive(table, filename, codec = None, level = None, block_rows = BLOCK_ROWS, delta = True):
+    """
+    Write a StateTable to filename as a compressed archive. codec is one of
+    available_codecs(); level is passed on to the compressor. With delta
+    off, no columns are stored as differences.
+    """
+    if codec is None:
+        codec = default_codec()
+    if codec not in available_codecs():
+        raise ValueError(f'codec {codec} is not available')
+    compress = CODECS[codec][0]
+
+    delta_fields = DELTA_FIELDS if delta else set()
+    columns = _block_columns(delta_fields)
+    transient_index = table.transients['index']
+    flag_index = table.flag_events['index']
+
+    #written next to the archive and moved into place once complete
+    temp = filename + '.tmp'
+    try:
+        blocks = []
+        with open(temp, 'wb') as fp:
+            fp.write(MAGIC + bytes([ARCHIVE_VERSION]))
+            for start in range(0, len(table), block_rows):
+                stop = min(start+block_rows, len(table))
+
+                parts = []
+                for name, dtype, differences in columns:
+                    column = np.ascontiguousarray(getattr(table, name)[start:stop], dtype)
+                    parts.append(_delta(column) if differences else column)
+
+                lo, hi = np.searchsorted(transient_index, [start, stop])
+                transients = table.transients[lo:hi].copy()
+                transients['index'] -= start
+                lo, hi = np.searchsorted(flag_index, [start, stop])
+                flag_events = table.flag_events[lo:hi].copy()
+                flag_events['index'] -= start
+                parts.extend([transients, flag_events])
+
+                data = compress(b''.join(x.tobytes() for x in parts), level)
+                blocks.append({
+                    'offset': fp.tell(),
+                    'size': len(data),
+                    'start': start,
+                    'rows': stop-start,
+                    'transients': len(transients),
+                    'flag_events': len(flag_events),
+                    'timestamps': [float(table.timestamp[start]), float(table.timestamp[stop-1])],
+                    })
+                fp.write(data)
+
+            index = {
+                'version': ARCHIVE_VERSION,
+                'codec': codec,
+                'rows': len(table),
+                'rooms': table.room_names,
+                'flag_names': table.flag_names,
+                'strings': table.strings,
+                'end': int(table.end),
+                'delta': sorted(delta_fields),
+                'blocks': blocks,
+                }
+            index_offset = fp.tell()
+            fp.write(json.dumps(index).encode('utf-8'))
+            fp.write(FOOTER.pack(index_offset, MAGIC))
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+class ArchiveReader():
+    """
+    Reads a compressed archive. Blocks are decompressed on demand, so a
+    range of rows can be loaded without touching the rest of the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            header = fp.read(len(MAGIC)+1)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{filename} is not a tuw archive')
+            if header[len(MAGIC)] != ARCHIVE_VERSION:
+                raise ValueError(f'{filename} is archive version {header[len(MAGIC)]}, expected {ARCHIVE_VERSION}')
+            fp.seek(-FOOTER.size, os.SEEK_END)
+            footer_offset = fp.tell()
+            index_offset, magic = FOOTER.unpack(fp.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{filename} is truncated')
+            fp.seek(index_offset)
+            index = json.loads(fp.read(footer_offset-index_offset))
+
+        self.codec = index['codec']
+        if self.codec not in available_codecs():
+            raise ValueError(f'{filename} needs the {self.codec} codec, which is not available')
+        self.rows = index['rows']
+        self.room_names = [sys.intern(x) for x in index['rooms']]
+        self.flag_names = [sys.intern(x) for x in index['flag_names']]
+        self.strings = _pairs(index['strings'])
+        self.end = index['end']
+        self.blocks = index['blocks']
+        self.delta_fields = set(index.get('delta', DELTA_FIELDS))
+        self.starts = [x['start'] for x in self.blocks]
+        self.cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def block_at(self, row):
+        """
+        Index of the block holding row
+        """
+        return bisect.bisect_right(self.starts, row)-1
+
+    def read_block(self, idx):
+        """
+        Decompress block idx into a StateTable holding just its rows. The
+        last few blocks read are kept, so reading many small ranges (e.g.
+        single runs) doesn't decompress the same block over and over.
+        """
+        table = self.cache.get(idx)
+        if table is None:
+            table = self._read_block(idx)
+            while len(self.cache) >= CACHED_BLOCKS:
+                del self.cache[next(iter(self.cache))]
+            self.cache[idx] = table
+        return table
+
+    def _read_block(self, idx):
+        block = self.blocks[idx]
+        with open(self.filename, 'rb') as fp:
+            fp.seek(block['offset'])
+            data = CODECS[self.codec][1](fp.read(block['size']))
+
+        rows = block['rows']
+        pos = 0
+        columns = {}
+        for name, dtype, delta in _block_columns(self.delta_fields):
+            column = np.frombuffer(data, dtype, rows, pos)
+            columns[name] = _undelta(column, dtype) if delta else column
+            pos += rows*dtype.itemsize
+        transients = np.frombuffer(data, TRANSIENT_DTYPE, block['transients'], pos)
+        pos += block['transients']*TRANSIENT_DTYPE.itemsize
+        flag_events = np.frombuffer(data, FLAG_DTYPE, block['flag_events'], pos)
+
+        table = StateTable()
+        table.filename = self.filename
+        table.room_code = columns.pop('room_code')
+        table.offsets = columns.pop('offsets').astype(np.int64)
+        table._set_columns(columns)
+        table.room_names = self.room_names
+        table.transients = transients
+        table.flag_events = flag_events
+        table.flag_names = self.flag_names
+        start = block['start']
+        table.strings = {k-start: v for k, v in self.strings.items() if start <= k < start+rows}
+        return table
+
+    def read(self, start = 0, stop = None, threads = None):
+        """
+        Load rows [start, stop) into one StateTable, decompressing the blocks
+        that cover them in a thread pool (the codecs release the GIL).
+        """
+        if stop is None:
+            stop = self.rows
+        stop = min(stop, self.rows)
+        if start >= stop:
+            table = StateTable()
+            table.filename = self.filename
+            return table
+
+        first, last = self.block_at(start), self.block_at(stop-1)
+        base = self.blocks[first]['start']
+        if first == last:
+            #slicing makes a new table, so the cached block is never modified
+            table = self.read_block(first)
+        else:
+            with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+                tables = list(pool.map(self._read_block, range(first, last+1)))
+            table = StateTable()
+            table.concatenate(tables)
+            if start == base and stop == base+len(table):
+                table.filename = self.filename
+                table.end = self.end
+                return table
+        table = table.slice(start-base, stop-base)
+        table.end = self.end
+        return table
+
+def read_archive(filename, threads = None):
+    return ArchiveReader(filename).read(threads=threads)
+
+def iter_archive(filename):
+    """
+    Yield a StateTable for each block of an archive in order, like
+    iter_tables does for a raw dump
+    """
+    reader = ArchiveReader(filename)
+    for idx in range(len(reader.blocks)):
+        yield reader._read_block(idx)
+
+def compress_dump(filename, output = None, codec = None, level = None, workers = 1):
+    """
+    Convert a raw dump to an archive, by default at filename + ARCHIVE_SUFFIX.
+    Returns the output filename.
+    """
+    if output is None:
+        output = filename + ARCHIVE_SUFFIX
+    table = StateTable(filename, workers=workers)
+    write_archive(table, output, codec, level)
+    return output
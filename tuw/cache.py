@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import shutil
+
+import numpy as np
+
+from .table import StateTable, FIELDS, _fingerprint
+
+#Sidecar cache of decoded StateTable columns, stored next to each dump as a
+#directory of .npy files plus a manifest. The manifest records the size and
+#mtime of the dump it was built from, so a dump that has changed since (or a
+#cache written by an older format) is rebuilt on the next load.
+
+CACHE_VERSION = 4
+CACHE_SUFFIX = '.tuwcache'
+MANIFEST = 'manifest.json'
+
+def cache_dir(filename):
+    return filename + CACHE_SUFFIX
+
+def _source_key(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def _pairs(data):
+    #json keys are always strings
+    return {int(k): v for k, v in data.items()}
+
+def read_cache(filename):
+    """
+    Load the cached table for filename with every column memory mapped, or
+    return None if there is no cache or it is stale.
+    """
+    path = cache_dir(filename)
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    if manifest.get('source') != _source_key(filename):
+        return None
+
+    table = StateTable()
+    table.filename = filename
+    try:
+        columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            for name, _ in FIELDS}
+        table.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        table.room_code = np.load(os.path.join(path, 'room_code.npy'), mmap_mode='r')
+        table.transients = np.load(os.path.join(path, 'transients.npy'))
+        table.flag_events = np.load(os.path.join(path, 'flag_events.npy'))
+    except (OSError, ValueError):
+        return None
+    table._set_columns(columns)
+
+    table.room_names = [sys.intern(x) for x in manifest['rooms']]
+    table.flag_names = [sys.intern(x) for x in manifest['flag_names']]
+    table.strings = _pairs(manifest['strings'])
+    table.end = manifest['end']
+    table.prefix = _fingerprint(filename, table.end)
+
+    return table
+
+def write_cache(table, filename, source = None):
+    """
+    Write the cache for table, decoded from filename. source is the file
+    size/mtime the table was decoded from if it was taken before decoding.
+    """
+    if source is None:
+        source = _source_key(filename)
+
+    path = cache_dir(filename)
+    os.makedirs(path, exist_ok=True)
+
+    #drop the manifest first so a half written cache is never considered valid
+    manifest_path = os.path.join(path, MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    for name, column in table.columns().items():
+        np.save(os.path.join(path, f'{name}.npy'), column)
+    np.save(os.path.join(path, 'offsets.npy'), table.offsets)
+
+    np.save(os.path.join(path, 'room_code.npy'), table.room_code)
+    np.save(os.path.join(path, 'transients.npy'), table.transients)
+    np.save(os.path.join(path, 'flag_events.npy'), table.flag_events)
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': source,
+        'rooms': table.room_names,
+        'flag_names': table.flag_names,
+        'strings': table.strings,
+        'end': int(table.end),
+        }
+    with open(manifest_path, 'w') as fp:
+        json.dump(manifest, fp)
+
+def clear_cache(filename):
+    shutil.rmtree(cache_dir(filename), ignore_errors=True)
+
+def load_table(filename, use_mmap = True, workers = 1):
+    """
+    Load filename from its cache if it is fresh, otherwise decode it and
+    write the cache for next time. Failing to write the cache (e.g. a read
+    only directory) is not an error.
+    """
+    table = read_cache(filename)
+    if table is not None:
+        return table
+
+    #stat first so a dump that grows while decoding reads as stale next time
+    source = _source_key(filename)
+    table = StateTable(filename, use_mmap, workers)
+    try:
+        write_cache(table, filename, source)
+    except OSError as e:
+        print(f"Couldn't write cache for {filename}: {e}")
+    return table
@@ -0,0 +1,261 @@
+import os
+import time
+import sqlite3
+
+from .tuw import StateDump, Run, segment_table
+from .table import read_packets
+from .archive import ARCHIVE_SUFFIX, ArchiveReader, is_archive
+
+#SQLite catalog of the runs in a directory of dumps, so runs can be found
+#without loading every dump. Each run row records where its packets are in
+#the dump, so a query can load just the runs it returns.
+
+CATALOG_VERSION = 1
+CATALOG_NAME = 'tuw_catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    size INTEGER,
+    mtime INTEGER,
+    chapter TEXT,
+    map TEXT,
+    states INTEGER
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER,
+    kind TEXT,
+    number INTEGER,
+    start INTEGER,
+    stop INTEGER,
+    start_offset INTEGER,
+    stop_offset INTEGER,
+    deaths INTEGER,
+    rooms TEXT,
+    duration REAL,
+    length REAL,
+    control INTEGER,
+    collection INTEGER,
+    state_change INTEGER,
+    mark_flags INTEGER,
+    start_x REAL,
+    start_y REAL,
+    death_x REAL,
+    death_y REAL,
+    start_timestamp REAL,
+    end_timestamp REAL
+);
+CREATE TABLE IF NOT EXISTS run_rooms (
+    run_id INTEGER,
+    room TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_file ON runs (file_id, kind);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (kind, start_timestamp);
+CREATE INDEX IF NOT EXISTS run_rooms_room ON run_rooms (room, run_id);
+CREATE INDEX IF NOT EXISTS run_rooms_run ON run_rooms (run_id);
+"""
+
+def default_kinds():
+    #ClipRun lives with the video cutting code, which needs moviepy
+    try:
+        from .cut_util import ClipRun
+    except ImportError as e:
+        print(f'Cataloging Run only, no ClipRun: {e}')
+        return {'Run': Run}
+    return {'Run': Run, 'ClipRun': ClipRun}
+
+def catalog_path(directory):
+    return os.path.join(directory, CATALOG_NAME)
+
+def find_dumps(directory):
+    """
+    Dumps and archives in directory. An archive made from a dump that is
+    still there is skipped so its runs aren't listed twice.
+    """
+    names = set(os.listdir(directory))
+    result = []
+    for name in sorted(names):
+        if name.endswith('.dump'):
+            result.append(os.path.join(directory, name))
+        elif name.endswith(ARCHIVE_SUFFIX) and name[:-len(ARCHIVE_SUFFIX)] not in names:
+            result.append(os.path.join(directory, name))
+    return result
+
+class Catalog():
+    """
+    A run catalog stored in the SQLite database at path. update() adds the
+    runs of new or changed dumps; find_runs() and load_runs() query it.
+    """
+
+    def __init__(self, path, kinds = None):
+        self.path = path
+        self.kinds = kinds if kinds is not None else default_kinds()
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS run_rooms;')
+            self.db.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, directory):
+        """
+        Catalog every dump in directory that is new or has changed since it
+        was last cataloged, and drop files that no longer exist. Returns the
+        number of files (re)cataloged.
+        """
+        paths = find_dumps(directory)
+        count = 0
+        for path in paths:
+            if self.add_file(path):
+                count += 1
+
+        directory = os.path.abspath(directory)
+        known = self.db.execute('SELECT id, path FROM files').fetchall()
+        keep = {os.path.abspath(x) for x in paths}
+        for row in known:
+            if os.path.dirname(row['path']) == directory and row['path'] not in keep:
+                self._remove(row['id'])
+        self.db.commit()
+        return count
+
+    def _remove(self, file_id):
+        self.db.execute('DELETE FROM run_rooms WHERE run_id IN (SELECT id FROM runs WHERE file_id = ?)', (file_id,))
+        self.db.execute('DELETE FROM runs WHERE file_id = ?', (file_id,))
+        self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def add_file(self, path):
+        """
+        Catalog the runs in one dump unless it is unchanged since it was last
+        cataloged. Returns True if it was (re)cataloged.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute('SELECT id, size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            if row['size'] == stat.st_size and row['mtime'] == stat.st_mtime_ns:
+                return False
+            self._remove(row['id'])
+
+        start_time = time.time()
+        try:
+            #read once, so no column cache next to every dump
+            dump = StateDump(path, cache=False)
+        except Exception as e:
+            print(f"Couldn't catalog {path}: {e}")
+            return False
+        table = dump.table
+
+        cursor = self.db.execute(
+            'INSERT INTO files (path, size, mtime, chapter, map, states) VALUES (?, ?, ?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime_ns, dump.chapter, dump.map, len(table)))
+        file_id = cursor.lastrowid
+
+        ends = list(table.offsets[1:].tolist()) + [table.end]
+        run_count = 0
+        kinds = list(self.kinds.items())
+        results = dump.extract_many([x for _, x in kinds])
+        for (kind, _), runs in zip(kinds, results):
+            for number, run in enumerate(runs):
+                self._add_run(file_id, kind, number, run, table.offsets, ends)
+                run_count += 1
+        self.db.commit()
+
+        print(f'cataloged {run_count} runs from {path} in {time.time()-start_time:.2f} s')
+        return True
+
+    def _add_run(self, file_id, kind, number, run, offsets, ends):
+        start, stop = run.row_range()
+        first, last = run.states[0], run.states[-1]
+        death = run.death_state
+        cursor = self.db.execute(
+            'INSERT INTO runs (file_id, kind, number, start, stop, start_offset, stop_offset, '
+            'deaths, rooms, duration, length, control, collection, state_change, mark_flags, '
+            'start_x, start_y, death_x, death_y, start_timestamp, end_timestamp) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_id, kind, number, start, stop,
+                int(offsets[start]), int(ends[stop-1]),
+                first.deaths, ','.join(run.room_order),
+                run.get_duration(), run.get_length(),
+                run.control, run.collection, run.state_change, run.mark_flags,
+                first.xpos, first.ypos,
+                death.xpos if death is not None else None,
+                death.ypos if death is not None else None,
+                first.timestamp, last.timestamp))
+        self.db.executemany('INSERT INTO run_rooms (run_id, room) VALUES (?, ?)',
+            [(cursor.lastrowid, x) for x in run.rooms])
+
+    def find_runs(self, kind = 'ClipRun', room = None, collection = 0, state_change = 0,
+                    since = None, until = None, path = None, deaths = None):
+        """
+        Catalog rows for the runs of the given kind matching every condition
+        given: visiting room, any of the collection/state_change bits set,
+        starting in [since, until) (unix timestamps), from the dump at path,
+        or with a death count in deaths. Each row also has the dump's path.
+        """
+        query = ['SELECT runs.*, files.path FROM runs JOIN files ON runs.file_id = files.id WHERE kind = ?']
+        args = [kind]
+        if room is not None:
+            query.append('AND runs.id IN (SELECT run_id FROM run_rooms WHERE room = ?)')
+            args.append(room)
+        if collection:
+            query.append('AND collection & ? != 0')
+            args.append(collection)
+        if state_change:
+            query.append('AND state_change & ? != 0')
+            args.append(state_change)
+        if since is not None:
+            query.append('AND start_timestamp >= ?')
+            args.append(since)
+        if until is not None:
+            query.append('AND start_timestamp < ?')
+            args.append(until)
+        if path is not None:
+            query.append('AND files.path = ?')
+            args.append(os.path.abspath(path))
+        if deaths is not None:
+            deaths = list(deaths)
+            query.append(f'AND deaths IN ({", ".join("?"*len(deaths))})')
+            args.extend(deaths)
+        query.append('ORDER BY files.path, start')
+        return self.db.execute(' '.join(query), args).fetchall()
+
+    def load_runs(self, rows):
+        """
+        Rebuild the runs for catalog rows, reading only their packets from
+        each dump. Returns the runs in the order of rows, leaving out rows
+        whose packets no longer make a run (e.g. the dump was rewritten).
+        """
+        runs = []
+        readers = {}
+        for row in rows:
+            path = row['path']
+            if row['kind'] not in self.kinds:
+                print(f"Warning: can't rebuild {row['kind']} runs, skipping")
+                continue
+            if is_archive(path):
+                if path not in readers:
+                    readers[path] = ArchiveReader(path)
+                table = readers[path].read(row['start'], row['stop'])
+            else:
+                table = read_packets(path, row['start_offset'], row['stop_offset'])
+
+            sequences = segment_table(table, self.kinds[row['kind']])
+            if len(sequences) == 0:
+                print(f"Warning: no {row['kind']} at packets {row['start']}-{row['stop']} of {path}, skipping")
+                continue
+            runs.append(sequences[0])
+        return runs
@@ -1,6 +1,11 @@
 
+import os
+import json
+import hashlib
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import sklearn.cluster as skcluster
 import sklearn.mixture
 
@@ -8,47 +13,144 @@ from matplotlib import pyplot as plt
 
 from . import tuw
 
+class RunGroup():
+    """
+    Rows of a group of runs in their table, so features can be read for
+    all of them at once: starts and stops, and deaths, the row of each
+    run's death state or of its last state if it has none. Runs that
+    aren't all views of one table are read state by state instead, which
+    only supports GameState attributes.
+    """
+    def __init__(self, runs):
+        self.runs = runs
+        self.table = None
+        if len(runs) > 0 and all(isinstance(x.states, tuw.StateList) for x in runs):
+            table = runs[0].states.table
+            if all(x.states.table is table for x in runs):
+                self.table = table
+
+        if self.table is not None:
+            rows = np.array([x.row_range() for x in runs], dtype=np.int64).reshape(-1, 2)
+            self.starts = rows[:, 0]
+            self.stops = rows[:, 1]
+            death = np.array([x.death_state_index for x in runs], dtype=np.int64)
+            self.deaths = np.where(death >= 0, self.starts+death, self.stops-1)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def column(self, name, which = 'start'):
+        """
+        Table column name at each run's start or death row, as floats
+        """
+        if self.table is not None:
+            rows = self.starts if which == 'start' else self.deaths
+            return np.asarray(getattr(self.table, name)[rows], dtype=np.float64)
+
+        if which == 'start':
+            states = [x.states[0] for x in self.runs]
+        else:
+            states = [x.states[-1] if x.death_state is None else x.death_state for x in self.runs]
+        return np.array([getattr(x, name) for x in states], dtype=np.float64)
+
+    def room_codes(self):
+        """
+        Start room of each run as the position of its name in the sorted
+        names of the group's start rooms, so views and lists agree
+        """
+        if self.table is not None:
+            names = np.array(self.table.room_names, dtype=object)[self.table.room_code[self.starts]]
+        else:
+            names = np.array([x.states[0].room for x in self.runs], dtype=object)
+        if len(names) == 0:
+            return np.zeros(0, dtype=np.float64)
+        return np.unique(names, return_inverse=True)[1].astype(np.float64)
+
+    def lengths(self):
+        if self.table is not None:
+            return np.asarray(self.table.paths().squared_length(self.starts, self.stops), dtype=np.float64)
+        return np.array([x.get_length() for x in self.runs], dtype=np.float64)
+
+    def durations(self):
+        if self.table is not None:
+            return np.asarray(self.table.paths().duration(self.starts, self.stops), dtype=np.float64)
+        return np.array([x.get_duration() for x in self.runs], dtype=np.float64)
+
+    def points(self, features = None):
+        """
+        Feature matrix of the runs, one row per run and one column per
+        feature. Features are names from FEATURES or functions of a
+        RunGroup returning one value per run.
+        """
+        if features is None:
+            features = DEFAULT_FEATURES
+        columns = [FEATURES[x](self) if isinstance(x, str) else x(self) for x in features]
+        points = np.empty((len(self), len(columns)), dtype=np.float64)
+        for idx, column in enumerate(columns):
+            points[:, idx] = column
+        return points
+
+#Features a run's point can be built from
+FEATURES = {
+    'index': lambda g: np.arange(len(g), dtype=np.float64),
+    'start_x': lambda g: g.column('xpos', 'start'),
+    'start_y': lambda g: g.column('ypos', 'start'),
+    'death_x': lambda g: g.column('xpos', 'death'),
+    'death_y': lambda g: g.column('ypos', 'death'),
+    'length': lambda g: g.lengths(),
+    'duration': lambda g: g.durations(),
+    'room': lambda g: g.room_codes(),
+    }
+
+DEFAULT_FEATURES = ('index', 'death_x', 'death_y', 'start_x', 'start_y')
+
 class RunStats:
-    def __init__(self, idx, run):
+    """
+    A run's point, cluster label, centroid and squared distance to it
+    """
+    def __init__(self, idx, run, point, label, centroid, dist):
         self.idx = idx
         self.run = run
-        self.point = self.get_point()
-
-    def get_point(self):
-
-        if self.run.death_state is not None:
-            death_state = self.run.death_state
-        else:
-            death_state = self.run.states[-1]
-
-        point = (self.run.get_length(),
-                death_state.xpos, death_state.ypos,
-                self.run.states[0].xpos, self.run.states[0].ypos)
-
-        point = (self.idx,
-                death_state.xpos, death_state.ypos,
-                self.run.states[0].xpos, self.run.states[0].ypos)
+        self.point = point
+        self.label = label
+        self.centroid = centroid
+        self.dist = dist
 
-        return point
-
-    def ingest_cluster(self, clusters):
-        self.label = clusters.labels_[self.idx]
-        self.centroid = get_centroid(clusters, self.label)
-        self.dist = sum([(x-y)**2 for x,y in zip(self.point, self.centroid)])
+def run_points(runs, features = None):
+    """
+    The feature matrix GroupClusters clusters runs on
+    """
+    return RunGroup(runs).points(features)
 
 class GroupClusters:
-    def __init__(self, runs):
+    def __init__(self, runs, cache = None, name = None, points = None, features = None):
+        """
+        With a ClusterCache, the clustering is looked up under name and only
+        fit if the points have changed since it was stored. points can be
+        given if they were already computed by run_points, otherwise they
+        are built from features (DEFAULT_FEATURES if None).
+        """
         self.runs = runs
+        self.group = RunGroup(runs)
+        if features is None:
+            features = DEFAULT_FEATURES
+        self.features = features
+        if points is None:
+            points = self.group.points(features)
+        self.points = points
+
+        if cache is not None:
+            self.clst = cache.get_clusters(name, points)
+        else:
+            self.clst = get_clusters(points)
 
-        self.run_stats = []
-        for idx, run in enumerate(runs):
-            self.run_stats.append(RunStats(idx, run))
-
-        points = [x.point for x in self.run_stats]
-        self.clst = get_clusters(points)
+        labels = self.labels = np.asarray(self.clst.labels_)
+        #noise is -1, which picks the last centroid
+        centroids = np.asarray(self.clst.centroids_)[labels]
+        self.dists = ((points-centroids)**2).sum(axis=1)
 
-        for stats in self.run_stats:
-            stats.ingest_cluster(self.clst)
+        self.run_stats = [RunStats(*x) for x in zip(range(len(runs)), runs,
+            points, labels.tolist(), centroids, self.dists.tolist())]
 
         self.stats_map = defaultdict(list)
         self.run_map = {}
@@ -56,28 +158,42 @@ class GroupClusters:
             self.stats_map[stats.label].append(stats)
             self.run_map[stats.run] = stats.label
 
-        #labels by size
-        label_map = defaultdict(list)
-        for idx, label in enumerate(self.clst.labels_):
-            label_map[label].append(points[idx])
+        #labels by size, ties in the order they first appear
+        found, first, counts = np.unique(labels, return_index=True, return_counts=True)
+        order = np.argsort(first, kind='stable')
+        order = order[np.argsort(-counts[order], kind='stable')]
+        self.labels_by_size = [(int(found[x]), points[labels == found[x]])
+            for x in order if found[x] != -1]
 
-        label_map.pop(-1, None)
-
-        self.labels_by_size = sorted(label_map.items(), key=lambda x: len(x[1]), reverse=True)
+    def get_centroid_features(self, label):
+        """
+        Centroid of label as a dict of named feature to value
+        """
+        centroid = get_centroid(self.clst, label)
+        return {x: float(y) for x, y in zip(self.features, centroid) if isinstance(x, str)}
 
     def get_run_cluster(self, run):
         return self.run_map[run]
 
-    def get_best_runs(self, n, metric = lambda x: x.dist):
-        #runs closest to each cluster centroid
-        self.best_map = {}
-        for label, stats in self.stats_map.items():
-            best = min(stats, key=metric)
-            self.best_map[label] = best
+    def get_best_runs(self, n, metric = None):
+        """
+        The run of each of the n largest clusters with the lowest metric,
+        which is an array with a value per run or a function of RunStats.
+        By default the run closest to the cluster centroid.
+        """
+        if metric is None:
+            metric = self.dists
+        elif callable(metric):
+            metric = np.array([metric(x) for x in self.run_stats])
+
+        #sorted by label then metric, so the first run of each label is best
+        order = np.lexsort((metric, self.labels))
+        labels = self.labels[order]
+        heads = np.flatnonzero(np.diff(labels, prepend=-2))
+        self.best_map = {int(labels[x]): self.run_stats[order[x]] for x in heads}
 
         self.best_runs_by_size = [self.best_map[label] for label, _ in self.labels_by_size]
 
-
         return [x.run for x in self.best_runs_by_size[:n]]
 
 
@@ -97,13 +213,146 @@ def get_centroid(clusters, label):
     return clusters.centroids_[label]
 
 
+HDBSCAN_PARAMS = {'min_cluster_size': 2, 'store_centers': 'centroid'}
+
 def get_clusters(points):
 #    hdb = skcluster.OPTICS()
 #    hdb.fit(points)
 #    return hdb
 
 
-    hdb = skcluster.HDBSCAN(min_cluster_size=2, store_centers = 'centroid')
+    hdb = skcluster.HDBSCAN(**HDBSCAN_PARAMS)
     hdb.fit(points)
     return hdb
 
+#Clusterings stored next to each dump, so reopening a dump doesn't fit
+#HDBSCAN again for rooms whose runs haven't changed. Each room keeps the
+#last clustering done on it along with a hash of the points and parameters
+#it came from, and is fit again when the hash differs.
+
+CLUSTER_VERSION = 2
+CLUSTER_SUFFIX = '.tuwclusters'
+
+def cluster_path(filename):
+    return filename + CLUSTER_SUFFIX
+
+def cluster_key(points, params = HDBSCAN_PARAMS):
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    digest.update(str(points.shape).encode())
+    digest.update(points.tobytes())
+    return digest.hexdigest()
+
+class StoredClusters():
+    """
+    The labels_ and centroids_ of a fit, which is all GroupClusters uses
+    """
+    def __init__(self, labels, centroids):
+        self.labels_ = labels
+        self.centroids_ = centroids
+
+def _fit(points):
+    #fit_many worker, errors are sent back to be raised by get_clusters
+    try:
+        clusters = get_clusters(points)
+        return clusters.labels_, clusters.centroids_
+    except Exception as e:
+        return e
+
+class ClusterCache():
+    """
+    entries maps a name to (key, labels, centroids), where centroids has a
+    column per feature of the points it came from. changed is set when
+    an entry is added or replaced and cleared by write. failed holds the
+    (key, error) of fits done by fit_many that raised, and isn't stored.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.failed = {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, filename):
+        """
+        The cache stored for filename, or an empty one
+        """
+        self = cls(filename)
+        try:
+            with open(cluster_path(filename), 'rb') as fp:
+                data = np.load(fp, allow_pickle=False)
+                meta = json.loads(str(data['meta']))
+                if meta.get('version') != CLUSTER_VERSION:
+                    return self
+                labels = data['labels']
+                centroids = data['centroids']
+        except (OSError, ValueError, KeyError):
+            return self
+
+        #centroids are stored flattened, each entry with its own width
+        label_pos, centroid_pos = 0, 0
+        for name, key, nlabels, ncentroids, width in meta['entries']:
+            size = ncentroids*width
+            self.entries[name] = (key,
+                labels[label_pos:label_pos+nlabels],
+                centroids[centroid_pos:centroid_pos+size].reshape(ncentroids, width))
+            label_pos += nlabels
+            centroid_pos += size
+        return self
+
+    def get_clusters(self, name, points):
+        key = cluster_key(points)
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == key:
+            return StoredClusters(entry[1], entry[2])
+        failure = self.failed.get(name)
+        if failure is not None and failure[0] == key:
+            raise failure[1]
+
+        clusters = get_clusters(points)
+        self.entries[name] = (key, clusters.labels_, clusters.centroids_)
+        self.changed = True
+        return clusters
+
+    def fit_many(self, named_points, workers = None):
+        """
+        Fit each (name, points) of named_points that doesn't have a stored
+        clustering in a pool of workers processes (by default one per cpu).
+        Only the point arrays are sent to the workers. A fit that raises is
+        kept in failed, so get_clusters raises it for just that name.
+        """
+        keys = {name: cluster_key(points) for name, points in named_points}
+        todo = [(name, points) for name, points in named_points
+            if self.entries.get(name, (None,))[0] != keys[name]]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(todo))
+        if workers <= 1:
+            return
+
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(_fit, [points for _, points in todo])
+            for (name, _), result in zip(todo, results):
+                if isinstance(result, Exception):
+                    self.failed[name] = (keys[name], result)
+                    continue
+                self.entries[name] = (keys[name], *result)
+                self.failed.pop(name, None)
+                self.changed = True
+
+    def write(self):
+        entries = [(name, key, len(labels), *np.shape(centroids))
+            for name, (key, labels, centroids) in self.entries.items()]
+        labels = [x[1] for x in self.entries.values()]
+        centroids = [np.ravel(x[2]) for x in self.entries.values()]
+        meta = {'version': CLUSTER_VERSION, 'entries': entries}
+
+        path = cluster_path(self.filename)
+        with open(path + '.tmp', 'wb') as fp:
+            np.savez(fp,
+                labels=np.concatenate(labels + [np.zeros(0, np.int64)]),
+                centroids=np.concatenate(centroids + [np.zeros(0)]),
+                meta=np.array(json.dumps(meta)))
+        os.replace(path + '.tmp', path)
+        self.changed = False
+
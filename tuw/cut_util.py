@@ -1,12 +1,17 @@
 import os
 import time
+import bisect
 import subprocess
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
+import scipy.sparse
 import moviepy.editor
 
 import tuw
 import tuw.clusters
+import tuw.index
 
 class ClipRun(tuw.StateSequence):
     """
@@ -24,7 +29,7 @@ class ClipRun(tuw.StateSequence):
     def add_state(self, state):
         if self.done: return
 
-        if (tuw.ControlFlags.dead in state.control_flags
+        if (state.control & tuw.CONTROL_DEAD
             or (len(self.states) > 0 and state.deaths != self.states[-1].deaths)
                 ):
             self.ending = True
@@ -35,6 +40,40 @@ class ClipRun(tuw.StateSequence):
 
         self._add_state(state)
 
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        #a run starts ending at a dead packet or a death count change, and
+        #ends after the first packet that is neither. A dead first packet is
+        #a run on its own. extra is the ending attribute.
+        dead = (table.control_flags[start:stop] & tuw.CONTROL_DEAD) != 0
+        deaths = table.deaths[start:stop]
+        ending = dead.copy()
+        ending[1:] |= deaths[1:] != deaths[:-1]
+        events = np.flatnonzero(ending)+start
+        others = np.flatnonzero(~ending)+start
+
+        result = []
+        row = start
+        while row < stop:
+            if dead[row-start]:
+                result.append((row, row+1, True, True))
+                row += 1
+                continue
+            idx = np.searchsorted(events, row+1)
+            if idx == len(events):
+                result.append((row, stop, False, False))
+                break
+            idx = np.searchsorted(others, events[idx]+1)
+            if idx == len(others):
+                result.append((row, stop, False, True))
+                break
+            result.append((row, int(others[idx])+1, True, True))
+            row = int(others[idx])+1
+        return tuw.segment_arrays(*np.array(result, np.int64).reshape(-1, 4).T)
+
+    def _restore(self, extra):
+        self.ending = extra
+
     #TODO for hacking on
     """
     def _add_state(self, state):
@@ -72,16 +111,20 @@ class ClipRun(tuw.StateSequence):
         return dist < 8*8
 
     def get_segments(self):
+        if isinstance(self.states, tuw.StateList):
+            segments = clip_segments(self.states.table, [self.states.start], [self.states.stop])
+            return list(zip(segments['start'].tolist(), segments['end'].tolist()))
+
         result = []
 
         #3853, 3810, 3811
         #this sure is a hideous way of removing paused segments
         #that aren't part of the beginning or end of a run
-        paused = self.states[0].control_flags.value&8
+        paused = self.states[0].control&tuw.CONTROL_PAUSED
         left = self.states[0]
         override = False
         for state in self.states[1:]:
-            tpaused = state.control_flags.value&8
+            tpaused = state.control&tuw.CONTROL_PAUSED
             if state.mark_flags & 0x04: #mark button 3
                 override = True
                 if len(result) > 0: #un-cut the last segment
@@ -107,6 +150,156 @@ class ClipRun(tuw.StateSequence):
         return result
 
 
+SEGMENT_DTYPE = np.dtype([('run', np.int64), ('start', np.float64), ('end', np.float64)])
+
+def clip_segments(table, starts, stops):
+    """
+    ClipRun.get_segments for every run holding the packets [starts, stops)
+    of table, as one array of (run, start, end) timestamps in run order.
+    Only the packets where the paused bit changes or mark 3 is held are
+    looked at one by one.
+    """
+    starts = np.asarray(starts, np.int64)
+    stops = np.asarray(stops, np.int64)
+    if len(starts) == 0:
+        return np.zeros(0, SEGMENT_DTYPE)
+    first, last = int(starts.min()), int(stops.max())
+    paused = table.control_flags[first:last] & tuw.CONTROL_PAUSED != 0
+    change = np.zeros(last-first, bool)
+    change[1:] = paused[1:] != paused[:-1]
+    mark = table.mark_flags[first:last] & 0x04 != 0 #mark button 3
+    events = np.flatnonzero(change | mark)+first
+    #the first packet of a run only sets the starting paused state
+    lo = np.searchsorted(events, starts+1)
+    hi = np.searchsorted(events, stops)
+
+    #runs without any events, or that end up without any cuts, are one
+    #segment
+    bounds = [[x] for x in np.stack([starts, stops-1], axis=1).tolist()]
+    for idx in np.flatnonzero(hi > lo).tolist():
+        start, stop = bounds[idx][0]
+        result = []
+        left = start
+        override = False
+        for row in events[lo[idx]:hi[idx]].tolist():
+            if mark[row-first]:
+                override = True
+                if len(result) > 0: #un-cut the last segment
+                    result.pop()
+            if change[row-first]:
+                if paused[row-first]: #pause
+                    result.append([left, row])
+                elif override:
+                    override = False
+                else: #mark the end of the pause as the next segment start
+                    left = row
+
+        if len(result) == 0:
+            continue
+        if result[-1][0] == left:
+            result[-1][1] = stop
+        else:
+            result.append([left, stop])
+        bounds[idx] = result
+
+    rows = np.array([y for x in bounds for y in x], np.int64).reshape(-1, 2)
+    result = np.zeros(len(rows), SEGMENT_DTYPE)
+    result['run'] = np.repeat(np.arange(len(bounds)), [len(x) for x in bounds])
+    result['start'] = table.timestamp[rows[:, 0]]
+    result['end'] = table.timestamp[rows[:, 1]]
+    return result
+
+def run_segments(runs):
+    """
+    get_segments for each of runs, with the runs viewing the same table done
+    together by clip_segments
+    """
+    result = [None]*len(runs)
+    tables = defaultdict(list)
+    for idx, run in enumerate(runs):
+        if isinstance(run.states, tuw.StateList):
+            tables[id(run.states.table)].append(idx)
+        else:
+            result[idx] = run.get_segments()
+
+    for indices in tables.values():
+        table = runs[indices[0]].states.table
+        rows = np.array([runs[x].row_range() for x in indices], np.int64).reshape(-1, 2)
+        segments = clip_segments(table, rows[:, 0], rows[:, 1])
+        for idx in indices:
+            result[idx] = []
+        for run, start, end in zip(segments['run'].tolist(), segments['start'].tolist(), segments['end'].tolist()):
+            result[indices[run]].append((start, end))
+    return result
+
+class FlagMatrix:
+    """
+    How many times each run sets and clears each flag, as sparse runs by
+    flag_names matrices, counted from a table's flag events. changed is
+    their sum.
+    """
+    def __init__(self, table, starts, stops):
+        self.names = list(table.flag_names)
+        self.codes = {x: i for i, x in enumerate(self.names)}
+        events = table.flag_events
+        run = tuw.table.range_positions(events['index'], starts, stops)
+        inside = run >= 0
+        run, flag, on = run[inside], events['flag'][inside].astype(np.int64), events['on'][inside]
+        shape = (len(starts), len(self.names))
+        self.set = self._counts(run[on], flag[on], shape)
+        self.cleared = self._counts(run[~on], flag[~on], shape)
+        self.changed = self.set + self.cleared
+
+    @staticmethod
+    def _counts(rows, columns, shape):
+        #duplicate entries are summed
+        data = np.ones(len(rows), np.int64)
+        return scipy.sparse.csr_matrix((data, (rows, columns)), shape=shape)
+
+    def runs_with(self, names):
+        """
+        Whether each run changes any of the flags in names
+        """
+        wanted = np.zeros(len(self.names), np.int64)
+        wanted[[self.codes[x] for x in names if x in self.codes]] = 1
+        return self.changed @ wanted > 0
+
+    def run_flags(self, idx):
+        """
+        FlagSet of run idx
+        """
+        return self._flag_set(self.names, *(x[idx].toarray()[0] for x in (self.changed, self.set, self.cleared)))
+
+    def totals(self):
+        """
+        FlagSet of all the runs together
+        """
+        return self._flag_set(self.names, *(x.sum(axis=0).A1 for x in (self.changed, self.set, self.cleared)))
+
+    @staticmethod
+    def _flag_set(names, changed, flags_set, cleared):
+        result = tuw.FlagSet()
+        for counts, into in ((changed, result.flags_changed), (flags_set, result.flags_set), (cleared, result.flags_cleared)):
+            for code in np.flatnonzero(counts).tolist():
+                into[names[code]] = int(counts[code])
+        return result
+
+def merge_flag_totals(matrices):
+    """
+    FlagSet totals over the runs of several FlagMatrix, matching flags by
+    name
+    """
+    codes = {}
+    for matrix in matrices:
+        for name in matrix.names:
+            codes.setdefault(name, len(codes))
+    totals = np.zeros((3, len(codes)), np.int64)
+    for matrix in matrices:
+        columns = np.array([codes[x] for x in matrix.names], np.int64)
+        for row, counts in enumerate((matrix.changed, matrix.set, matrix.cleared)):
+            totals[row, columns] += counts.sum(axis=0).A1
+    return FlagMatrix._flag_set(list(codes), *totals)
+
 class RunInclusion:
     def __init__(self, index, run, conditions):
         self.index = index
@@ -125,16 +318,19 @@ class RunInclusion:
 
 
         lines.append('')
-        condition_keys = ['room_change', 'state change', 'collection', 'spawn change prev', 'spawn change next', 'cluster', 'long fail', 'numbers', 'mark', 'postmark']
+        condition_keys = ['room_change', 'state change', 'collection', 'spawn change prev', 'spawn change next', 'cluster', 'long fail', 'numbers', 'mark', 'postmark', 'catalog']
         condition_lines = [x for x in condition_keys if x in self.conditions]
         lines.extend(condition_lines)
 
         return '\n'.join(lines)
 
 class ClusterManager:
-    def __init__(self, room, room_runs):
+    def __init__(self, room, room_runs, cache = None, points = None, features = None):
         self.room = room
         self.room_runs = room_runs
+        self.cache = cache
+        self.points = points
+        self.features = features
         self.run_to_cluster = {}
         self.cluster_to_runs = defaultdict(list)
 
@@ -142,7 +338,7 @@ class ClusterManager:
 
     def compute_clusters(self):
         try:
-            grp = self.grp = tuw.clusters.GroupClusters(self.room_runs)
+            grp = self.grp = tuw.clusters.GroupClusters(self.room_runs, self.cache, self.room, self.points, self.features)
             for run, cluster in grp.run_map.items():
                 self.run_to_cluster[run] = cluster
                 self.cluster_to_runs[cluster].append(run)
@@ -158,13 +354,20 @@ class ClusterManager:
     def select_clusters(self):
         count = len(self.grp.labels_by_size)
         N = int(count/6)
-        self.cluster_runs = self.grp.get_best_runs(N, lambda x:x.run.states[0].sequence)
+        self.cluster_runs = self.grp.get_best_runs(N, self.grp.group.column('sequence'))
 
 
 class CutInput:
 
-    def __init__(self, infile):
+    def __init__(self, infile, workers = None, features = None):
+        """
+        workers is the number of processes rooms are clustered in, by
+        default one per cpu. features are the tuw.clusters features runs
+        are clustered on, DEFAULT_FEATURES if None.
+        """
         self.infile = infile
+        self.workers = workers
+        self.features = features
         self.load()
 
     def load(self):
@@ -177,52 +380,140 @@ class CutInput:
         print(states.chapter)
         print(states.rooms)
 
-        self.runs = runs = states.extract_sequences(ClipRun)
+        self.runs = runs = states.follow(ClipRun)
         print(f'{len(runs)} total runs')
 
+        self.cluster_cache = tuw.clusters.ClusterCache.load(self.infile)
 
-        self.room_map = room_map = defaultdict(list)
-        for run in runs:
-            for room in run.rooms:
-                room_map[room].append(run)
-
-        self.flag_changes = tuw.FlagSet()
-        for run in runs:
-            self.flag_changes.merge_into_self(run.flag_changes)
-
+        self.index_runs()
         self.compute_clusters()
 
-    def compute_clusters(self):
+    def refresh(self):
+        """
+        Pick up runs appended to a dump that is still being written. Only the
+        rooms touched by new or extended runs are re-clustered. Returns the
+        number of new states.
+        """
+        first = len(self.runs)
+        if first > 0 and not self.runs[-1].done:
+            first -= 1
+
+        count = self.states.refresh()
+        if count == 0:
+            return 0
+
+        self.index_runs()
+        if count == len(self.states.table):
+            #every state is new, e.g. the dump was rewritten
+            self.compute_clusters()
+        else:
+            rooms, _ = self.run_rooms(first)
+            self.compute_clusters(set(rooms.tolist()))
+
+        print(f'{count} new states, {len(self.runs)} total runs')
+        return count
+
+    def index_runs(self):
+        #runs are contiguous rows of the table, so the flag and transient
+        #aggregates come straight from its sparse event tables
+        table = self.states.table
+        rows = np.array([x.row_range() for x in self.runs], dtype=np.int64).reshape(-1, 2)
+        self.run_starts = rows[:, 0]
+        self.run_stops = rows[:, 1]
+
+        #runs by the code of each room they pass through, in run order
+        rooms, run_idx = self.run_rooms()
+        bounds = np.flatnonzero(np.diff(rooms))+1
+        self.room_map = {int(rooms[x[0]]): [self.runs[i] for i in run_idx[x].tolist()]
+            for x in np.split(np.arange(len(rooms)), bounds) if len(x) > 0}
+
+        self.run_state_change = table.transient_flags('state_change_flags', self.run_starts, self.run_stops)
+        self.run_collection = table.transient_flags('collection_flags', self.run_starts, self.run_stops)
+        self.flags = FlagMatrix(table, self.run_starts, self.run_stops)
+        self.flag_changes = self.flags.totals()
+        self.run_index = tuw.index.RunIndex(table.deaths[self.run_starts])
+
+    def run_rooms(self, first = 0):
+        """
+        (rooms, runs) arrays pairing the index of each run from first on
+        with the code of every room it passes through, sorted by room code
+        then run
+        """
+        table = self.states.table
+        starts, stops = self.run_starts[first:], self.run_stops[first:]
+        changes = table.room_changes()
+        pos = tuw.table.range_positions(changes, starts, stops)
+        runs = np.concatenate([np.arange(len(starts)), pos[pos >= 0]])
+        rooms = np.concatenate([table.room_code[starts], table.room_code[changes[pos >= 0]]]).astype(np.int64)
+        pairs = np.unique(rooms*(len(starts)+1) + runs)
+        return pairs//(len(starts)+1), pairs%(len(starts)+1)+first
+
+    def room_name(self, room):
+        """
+        Name of a room code in room_map, room_to_clusters and cluster_map
+        """
+        return self.states.table.room_names[room]
+
+    def run_flag_changes(self, idx):
+        return self.flags.run_flags(idx)
+
+    def compute_clusters(self, rooms = None):
+        """
+        Cluster the runs in each of rooms, or in every room if rooms is None,
+        then merge the per room results. Rooms whose runs are unchanged since
+        the dump's cluster cache was written aren't fit again.
+        """
+        if rooms is None:
+            self.room_results = {}
+            rooms = self.room_map.keys()
+
+        #fit the rooms in parallel first, the loop below then finds them in
+        #the cache
+        named_points = [(room, tuw.clusters.run_points(self.room_map[room], self.features)) for room in rooms]
+        self.cluster_cache.fit_many(named_points, self.workers)
+
+        for room, points in named_points:
+            self.room_results[room] = self.compute_room_clusters(room, self.room_map[room], points)
 
         self.room_to_clusters = {}
-
         self.cluster_runs = cluster_runs = []
         self.longest_fails = longest_fails = []
-
         self.cluster_map = {}
-        for room, room_runs in self.room_map.items():
-            cm = ClusterManager(room, room_runs)
-            try:
-                cm.compute_clusters()
+        for room in self.room_map.keys():
+            cm, cluster_map, room_cluster_runs, longest = self.room_results[room]
+            if cm is not None:
                 self.room_to_clusters[room] = cm
-            except:
-                pass
-            try:
-                grp = tuw.clusters.GroupClusters(room_runs)
-                for run, cluster in grp.run_map.items():
-                    self.cluster_map[run] = (room, cluster)
-            except (ValueError, IndexError) as e:
-                #print(f'Failed to cluster on {room}: {e}')
-                pass
-            else:
-                count = len(grp.labels_by_size)
-                N = int(count/6)
-                cluster_runs.extend(grp.get_best_runs(N, lambda x:x.run.states[0].sequence))
-            sub_runs = list(filter(lambda x: len(x.rooms) == 1, room_runs))
-            if len(sub_runs) >= 10:
-                longest = max(sub_runs, key= lambda x: x.get_length())
+            self.cluster_map.update(cluster_map)
+            cluster_runs.extend(room_cluster_runs)
+            if longest is not None:
                 longest_fails.append(longest)
 
+        if self.cluster_cache.changed:
+            try:
+                self.cluster_cache.write()
+            except OSError as e:
+                print(f"Couldn't write clusters for {self.infile}: {e}")
+
+    def compute_room_clusters(self, room, room_runs, points = None):
+        cluster_map = {}
+        cluster_runs = []
+        longest = None
+
+        cm = ClusterManager(room, room_runs, self.cluster_cache, points, self.features)
+        try:
+            cm.compute_clusters()
+        except:
+            cm = None
+        else:
+            for run, cluster in cm.run_to_cluster.items():
+                cluster_map[run] = (room, cluster)
+            cluster_runs.extend(cm.cluster_runs)
+        sub_runs = list(filter(lambda x: len(x.rooms) == 1, room_runs))
+        if len(sub_runs) >= 10:
+            longest = max(sub_runs, key= lambda x: x.get_length())
+
+        return cm, cluster_map, cluster_runs, longest
+
 
     def extract_runs(self, state_change_flags, collection_flags, numbers, flag_whitelist = None,
                     room_change = True, state_change = True,
@@ -237,9 +528,17 @@ class CutInput:
         included_runs = set()
 
         flag_changes = False
-        if tuw.StateChangeFlags.flag.value & state_change_flags != 0:
+        if tuw.STATE_CHANGE_FLAG & state_change_flags != 0:
             flag_changes = True
 
+        run_change_flags = self.run_state_change & state_change_flags
+        run_collection = self.run_collection & collection_flags
+        number_runs = set(self.run_index.with_deaths(numbers).tolist())
+        if flag_whitelist is not None:
+            whitelisted = self.flags.runs_with(flag_whitelist)
+        cluster_runs = set(self.cluster_runs)
+        longest_fails = set(self.longest_fails)
+
         counts = defaultdict(lambda:0)
         unique_counts = defaultdict(lambda:0)
         for idx, run in enumerate(runs):
@@ -265,29 +564,27 @@ class CutInput:
                 if len(run.rooms) >1 or idx == 0 or idx == len(runs)-1:
                     conditions.add('room_change')
             if state_change:
-                run_change_flags = run.state_change_flags.value & state_change_flags
-                if run_change_flags:
-                    if flag_changes and run_change_flags == tuw.StateChangeFlags.flag.value:
+                if run_change_flags[idx]:
+                    if flag_changes and run_change_flags[idx] == tuw.STATE_CHANGE_FLAG:
                         if flag_whitelist is not None:
-                            passing_flags = run.flag_changes.flags_changed.keys() & flag_whitelist
-                            if len(passing_flags) > 0:
+                            if whitelisted[idx]:
                                 conditions.add('state change')
                         else:
                             conditions.add('state change')
                     else:
                         conditions.add('state change')
             if collection:
-                if run.collection_flags.value & collection_flags:
+                if run_collection[idx]:
                     conditions.add('collection')
             if spawn_change:
                 if idx < len(runs)-1 and not run.match_spawn(runs[idx+1]):
                     conditions.add('spawn change next')
-                if idx > 0 and not run.match_spawn(runs[idx-1]) and not (run.state_change_flags.value&0x01 == 0):
+                if idx > 0 and not run.match_spawn(runs[idx-1]) and self.run_state_change[idx]&tuw.STATE_CHANGE_RESPAWN:
                     conditions.add('spawn change prev')
             if long_fail:
-                if run in self.longest_fails:
+                if run in longest_fails:
                     conditions.add('long fail')
-            if run.states[0].deaths in numbers:
+            if idx in number_runs:
                 conditions.add('numbers')
 
             if len(conditions) > 0:
@@ -302,7 +599,7 @@ class CutInput:
                 export_runs.append(RunInclusion(idx, run, conditions))
                 included_runs.add(idx)
 
-                if run in self.cluster_runs and not 'cluster' in conditions:
+                if run in cluster_runs and not 'cluster' in conditions:
                     counts['cluster'] += 1
 
         if clusters:
@@ -312,7 +609,7 @@ class CutInput:
                 conditions = set()
                 cluster = self.cluster_map.get(run, None)
 
-                if run in self.cluster_runs and not cluster in extant_clusters:
+                if run in cluster_runs and not cluster in extant_clusters:
                     conditions.add('cluster')
 
                 if len(conditions) > 0:
@@ -327,9 +624,52 @@ class CutInput:
 
         export_runs = list(sorted(export_runs, key=lambda x: x.index))
 
+        #clusters by room name for the UIs
+        extant_clusters = {None if x is None else (self.room_name(x[0]), x[1]) for x in extant_clusters}
+
         return export_runs, counts, unique_counts, extant_clusters
 
 
+def load_inputs(infiles, workers = None, progress = None, features = None):
+    """
+    CutInput for each of infiles, in the same order, loaded in a pool of
+    workers processes and clustered on features. By default there is one
+    worker per file, up to one per cpu. With a single worker the files are
+    loaded here instead, each clustering its rooms in parallel.
+    progress(done, total, infile) is called as each file finishes. Tables
+    loaded from a cache are sent back as references to the cache files and
+    stay memory mapped.
+    """
+    infiles = list(infiles)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    #more processes than files would sit idle
+    workers = min(workers, len(infiles))
+
+    result = [None]*len(infiles)
+    if workers <= 1:
+        for idx, infile in enumerate(infiles):
+            result[idx] = _load_input(infile, None, features)
+            if progress is not None:
+                progress(idx+1, len(infiles), infile)
+        return result
+
+    with ProcessPoolExecutor(workers) as pool:
+        #one process per file already, so rooms are clustered in-process
+        futures = {pool.submit(_load_input, x, 1, features): idx for idx, x in enumerate(infiles)}
+        for done, future in enumerate(as_completed(futures)):
+            idx = futures[future]
+            result[idx] = future.result()
+            if progress is not None:
+                progress(done+1, len(infiles), infiles[idx])
+    return result
+
+def _load_input(infile, workers, features):
+    try:
+        return CutInput(infile, workers, features)
+    except Exception as e:
+        print(f"Couldn't load {infile}: {e}")
+        raise
 
 class Clipper:
 
@@ -344,20 +684,30 @@ class Clipper:
             vidname, event, stamp = [x.strip('"') for x in line.split(',')]
             video_index[vidname][event] = float(stamp)
 
+        #videos by start time, for bisecting
+        videos = sorted((v['start'], k) for k, v in video_index.items() if 'start' in v and 'stop' in v)
+        self.video_starts = [x[0] for x in videos]
+        self.video_names = [x[1] for x in videos]
+
     def get_clip_info(self, start, end):
         #TODO: handle corner cases where a run spans 2 videos
         #or extends past the edge of a video
-        for vidname, events in self.video_index.items():
-            if events['start'] <= start and events['stop'] >= end:
-                return vidname, events['start']
+        #the latest video starting before start is the one that can hold it,
+        #unless recordings overlap
+        idx = bisect.bisect_right(self.video_starts, start)-1
+        while idx >= 0:
+            vidname = self.video_names[idx]
+            if self.video_index[vidname]['stop'] >= end:
+                return vidname, self.video_starts[idx]
+            idx -= 1
         raise RuntimeError(f"Couldn't find video matching stamps {start}, {end}")
 
     def compute_clips(self, export_runs):
         self.source_video_map = source_video_map = {}
         segments = []
-        for run in export_runs:
+        for clip_times in run_segments(export_runs):
 
-            for start, end in run.get_segments():
+            for start, end in clip_times:
                 try:
                     vidname, video_start_time = self.get_clip_info(start, end)
                 except RuntimeError as e:
@@ -0,0 +1,114 @@
+import numpy as np
+
+#Sorted in-memory indexes over a loaded table, so lookups by timestamp,
+#sequence number or death count are a binary search instead of a scan over
+#the states. Most columns are already in order in a dump, in which case
+#the column itself is the index and nothing is copied.
+
+class SortedColumn():
+    """
+    values in sorted order along with the position each came from. Equal
+    values keep their original order.
+    """
+    def __init__(self, values):
+        values = np.asarray(values)
+        if len(values) < 2 or np.all(values[1:] >= values[:-1]):
+            self.values = values
+            self.order = None
+        else:
+            self.order = np.argsort(values, kind='stable')
+            self.values = values[self.order]
+
+    def __len__(self):
+        return len(self.values)
+
+    def _position(self, idx):
+        return int(idx if self.order is None else self.order[idx])
+
+    def first_from(self, value):
+        """
+        Position of the smallest value >= value, or None if there is none
+        """
+        idx = np.searchsorted(self.values, value, 'left')
+        if idx >= len(self.values):
+            return None
+        return self._position(idx)
+
+    def equal(self, value):
+        """
+        Positions holding value, in their original order
+        """
+        lo = np.searchsorted(self.values, value, 'left')
+        hi = np.searchsorted(self.values, value, 'right')
+        if self.order is None:
+            return np.arange(lo, hi)
+        return self.order[lo:hi]
+
+    def isin(self, values):
+        """
+        Positions holding any of values, in order
+        """
+        values = np.sort(np.array(list(values)))
+        lo = np.searchsorted(self.values, values, 'left')
+        hi = np.searchsorted(self.values, values, 'right')
+        result = np.concatenate([np.arange(a, b) for a, b in zip(lo.tolist(), hi.tolist())] + [np.zeros(0, np.int64)])
+        if self.order is not None:
+            result = self.order[result]
+        return np.sort(result)
+
+class TableIndex():
+    """
+    Timestamp, sequence and death count indexes of a StateTable. Each is
+    built the first time it is used, and rebuilt if the table has grown
+    since.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.columns = {}
+        self.rows = 0
+
+    def column(self, name):
+        if self.rows != len(self.table):
+            self.columns = {}
+            self.rows = len(self.table)
+        if name not in self.columns:
+            self.columns[name] = SortedColumn(getattr(self.table, name))
+        return self.columns[name]
+
+    def at_time(self, timestamp):
+        """
+        Row of the earliest state at or after timestamp, or None
+        """
+        return self.column('timestamp').first_from(timestamp)
+
+    def for_sequence(self, sequence):
+        """
+        Row of the state with sequence number sequence, or None
+        """
+        rows = self.column('sequence').equal(sequence)
+        if len(rows) == 0:
+            return None
+        return int(rows[0])
+
+    def for_deaths(self, deaths):
+        """
+        Rows of the first and last states with death count deaths, or None
+        """
+        rows = self.column('deaths').equal(deaths)
+        if len(rows) == 0:
+            return None
+        return int(rows[0]), int(rows[-1])
+
+class RunIndex():
+    """
+    Finds runs by the death count they start with, given the starting death
+    count of each run in order.
+    """
+    def __init__(self, deaths):
+        self.deaths = SortedColumn(deaths)
+
+    def with_deaths(self, numbers):
+        """
+        Indices of the runs starting at any of the death counts in numbers
+        """
+        return self.deaths.isin(numbers)
@@ -58,7 +58,7 @@ class Plotter():
     def _state_box(x):
         pos = (x.xpos-4, -x.ypos)
         h = 11
-        if tuw.StatusFlags.crouched in x.status_flags:
+        if x.status & tuw.STATUS_CROUCHED:
             h = 6
         if tuw.PlayerState.star_fly == x.state:
             h = 8
@@ -88,7 +88,7 @@ class Plotter():
         self._add_point(x, 'b')
 
         for x in seq.states[1:]:
-            if not tuw.ControlFlags.dead in x.control_flags:
+            if not x.control & tuw.CONTROL_DEAD:
                 self._add_point(x, 'k')
             else:
                 self._add_point(x, 'r')
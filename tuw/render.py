@@ -44,11 +44,11 @@ class Plotter():
     def _state_box(x):
         pos = [x.xpos-4, x.ypos]
         h = 11
-        if tuw.StatusFlags.crouched in x.status_flags:
+        if x.status & tuw.STATUS_CROUCHED:
             h = 6
         if tuw.PlayerState.star_fly == x.state:
             h = 8
-        if tuw.ControlFlags.gravity_inverted not in x.control_flags:
+        if not x.control & tuw.CONTROL_GRAVITY_INVERTED:
             pos[1] -= h
         pos = tuple(pos)
         return (*pos, 8, h)
@@ -143,10 +143,10 @@ class Plotter():
 
             self._rect(0, rect, (0,0,0,128))
 
-            if tuw.ControlFlags.dead in x.control_flags:
+            if x.control & tuw.CONTROL_DEAD:
                 self._rect(10, rect, (255,0,0,128))
 
-            if tuw.StateChangeFlags.spawn in x.state_change_flags:
+            if x.state_change & tuw.STATE_CHANGE_SPAWN:
                 self._rect(21, rect, (0,0,255,255))
 
             if x.state == tuw.PlayerState.dash:
@@ -0,0 +1,361 @@
+import operator
+
+import numpy as np
+
+from .tuw import StateSequence, StateList
+from .table import TRANSIENT_FIELDS, event_ranges
+
+#Sequences described by conditions on packet fields instead of an add_state
+#loop. The conditions are evaluated over whole table columns at once, so
+#segmenting a dump with them runs at about the speed of the built-in runs,
+#and on single states for sequences fed state by state.
+#
+#class Fall(rules.RuleSequence):
+#    end = rules.flag('control_flags', tuw.CONTROL_DEAD)
+#    split = rules.changed('room')
+#    require = rules.field('ypos') > 200
+
+#GameState attribute holding each StateTable column, where they differ
+ATTRIBUTES = {
+    'state': 'player_state',
+    'control_flags': 'control',
+    'status_flags': 'status',
+    'button_flags': 'buttons',
+    'direction_flags': 'directions',
+    'collection_flags': 'collection',
+    'state_change_flags': 'state_change',
+    }
+
+TRANSIENT_TYPES = dict(TRANSIENT_FIELDS)
+
+class Columns():
+    """
+    Columns of the packets [start, stop) of a StateTable, fetched when a
+    condition first asks for them. Sparse transients are expanded, room is
+    the room name and floats are widened to match python's comparisons.
+    """
+    def __init__(self, table, start, stop):
+        self.table = table
+        self.start = start
+        self.stop = stop
+        self.cache = {}
+
+    def __len__(self):
+        return self.stop-self.start
+
+    def get(self, name):
+        if name in self.cache:
+            return self.cache[name]
+        table = self.table
+        if name == 'room':
+            values = np.array(table.room_names, dtype=object)[table.room_code[self.start:self.stop]]
+        elif name in TRANSIENT_TYPES:
+            values = np.zeros(len(self), TRANSIENT_TYPES[name])
+            lo, hi = event_ranges(table.transients['index'], self.start, self.stop)
+            events = table.transients[lo:hi]
+            values[events['index']-self.start] = events[name]
+        else:
+            values = getattr(table, name)[self.start:self.stop]
+            if values.dtype.kind == 'f':
+                values = values.astype(np.float64)
+        self.cache[name] = values
+        return values
+
+class Condition():
+    """
+    A test on a packet, which may look at the packet before it in the same
+    sequence. Combine with &, | and ~.
+    """
+    def mask(self, columns, first = False):
+        """
+        Result for every packet of columns. With first, each packet is
+        tested as the first of a sequence, with no packet before it.
+        """
+        raise NotImplementedError
+
+    def test(self, state, previous):
+        """
+        Result for a GameState, previous is the state before it or None
+        """
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+class All(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def mask(self, columns, first = False):
+        result = np.ones(len(columns), bool)
+        for x in self.conditions:
+            result &= x.mask(columns, first)
+        return result
+
+    def test(self, state, previous):
+        return all(x.test(state, previous) for x in self.conditions)
+
+class Any(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def mask(self, columns, first = False):
+        result = np.zeros(len(columns), bool)
+        for x in self.conditions:
+            result |= x.mask(columns, first)
+        return result
+
+    def test(self, state, previous):
+        return any(x.test(state, previous) for x in self.conditions)
+
+class Not(Condition):
+    def __init__(self, condition):
+        self.condition = condition
+
+    def mask(self, columns, first = False):
+        return ~self.condition.mask(columns, first)
+
+    def test(self, state, previous):
+        return not self.condition.test(state, previous)
+
+def _isin(values, choices):
+    if isinstance(values, np.ndarray):
+        return np.isin(values, list(choices))
+    return values in choices
+
+def _any_bits(values, bits):
+    return values & bits != 0
+
+def _all_bits(values, bits):
+    return values & bits == bits
+
+class Compare(Condition):
+    """
+    op(field value, other), where op works on both arrays and scalars
+    """
+    def __init__(self, field, op, other):
+        self.field = field
+        self.op = op
+        self.other = other
+
+    def mask(self, columns, first = False):
+        return np.asarray(self.op(columns.get(self.field.name), self.other), bool)
+
+    def test(self, state, previous):
+        return bool(self.op(self.field.value(state), self.other))
+
+class Changed(Condition):
+    """
+    The field differs from the packet before, never true on the first packet
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def mask(self, columns, first = False):
+        result = np.zeros(len(columns), bool)
+        if not first:
+            values = columns.get(self.field.name)
+            result[1:] = values[1:] != values[:-1]
+        return result
+
+    def test(self, state, previous):
+        return previous is not None and self.field.value(state) != self.field.value(previous)
+
+class Field():
+    """
+    A packet field by its StateTable column name (or room), compared with
+    values to make conditions, e.g. field('ypos') < -3000 or
+    field('room') == 'a-01'. Flags are raw integers.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.attribute = ATTRIBUTES.get(name, name)
+
+    def value(self, state):
+        return getattr(state, self.attribute)
+
+    def __eq__(self, other):
+        return Compare(self, operator.eq, other)
+
+    def __ne__(self, other):
+        return Compare(self, operator.ne, other)
+
+    def __lt__(self, other):
+        return Compare(self, operator.lt, other)
+
+    def __le__(self, other):
+        return Compare(self, operator.le, other)
+
+    def __gt__(self, other):
+        return Compare(self, operator.gt, other)
+
+    def __ge__(self, other):
+        return Compare(self, operator.ge, other)
+
+    def isin(self, values):
+        return Compare(self, _isin, set(values))
+
+    def any(self, bits):
+        """
+        Any of the flag bits are set, bits can be an int or flag enum
+        """
+        return Compare(self, _any_bits, getattr(bits, 'value', bits))
+
+    def all(self, bits):
+        return Compare(self, _all_bits, getattr(bits, 'value', bits))
+
+    def changed(self):
+        return Changed(self)
+
+def field(name):
+    return Field(name)
+
+def flag(name, bits):
+    return Field(name).any(bits)
+
+def changed(name):
+    return Field(name).changed()
+
+class RuleSequence(StateSequence):
+    """
+    A StateSequence set up by conditions in class attributes instead of an
+    add_state, any of which can be None:
+
+    begin: packets are skipped until one matching begin starts a sequence
+    end: a matching packet is added and ends the sequence
+    split: a matching packet ends the sequence without being added.
+        Ignored on the first packet.
+    trailing: packets after the end packet are added while they match. The
+        first one that doesn't ends the sequence without being added.
+    min_states, require, exclude: the sequence is valid if it has at least
+        min_states states, at least one matching require and none matching
+        exclude
+
+    Segmenting a table goes through segment_rows, which evaluates the
+    conditions over the table's columns. Subclasses shouldn't override
+    add_state, or they are fed state by state again.
+    """
+    begin = None
+    end = None
+    split = None
+    trailing = None
+
+    min_states = 2
+    require = None
+    exclude = None
+
+    def __init__(self):
+        super().__init__()
+        self.ending = False
+
+    def add_state(self, state):
+        if self.done: return
+
+        previous = self.states[-1] if len(self.states) > 0 else None
+        if previous is None:
+            if self.begin is not None and not self.begin.test(state, None):
+                return
+        elif self.ending:
+            if not self.trailing.test(state, previous):
+                self.done = True
+                return
+        elif self.split is not None and self.split.test(state, previous):
+            self.done = True
+            return
+
+        self._add_state(state)
+        if not self.ending and self.end is not None and self.end.test(state, previous):
+            if self.trailing is None:
+                self.done = True
+            else:
+                self.ending = True
+
+    def valid(self):
+        if len(self.states) < self.min_states:
+            return False
+        if self.require is not None and not self.matches(self.require):
+            return False
+        if self.exclude is not None and self.matches(self.exclude):
+            return False
+        return True
+
+    def matches(self, condition):
+        """
+        Whether any state of the sequence matches condition
+        """
+        if isinstance(self.states, StateList):
+            return bool(condition.mask(Columns(self.states.table, *self.row_range())).any())
+        previous = None
+        for state in self.states:
+            if condition.test(state, previous):
+                return True
+            previous = state
+        return False
+
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        #add_state, jumping from one packet that matters to the next.
+        #Finished sequences shorter than min_states are left out, extra is
+        #the ending attribute.
+        columns = Columns(table, start, stop)
+        def rows(condition, first = False):
+            if condition is None:
+                return None
+            return np.flatnonzero(condition.mask(columns, first))+start
+
+        begins = rows(cls.begin, True)
+        first_ends = rows(cls.end, True)
+        ends = rows(cls.end)
+        splits = rows(cls.split)
+        breaks = None if cls.trailing is None else rows(~cls.trailing)
+
+        def following(found, row):
+            #first of the rows found at or after row, or stop
+            if found is None:
+                return stop
+            idx = found.searchsorted(row)
+            return int(found[idx]) if idx < len(found) else stop
+
+        result = []
+        row = start
+        while row < stop:
+            first = following(begins, row) if begins is not None else row
+            if first >= stop:
+                break
+            if following(first_ends, first) == first:
+                end = first
+            else:
+                end = following(ends, first+1)
+                split = following(splits, first+1)
+                if split < stop and split <= end:
+                    result.append((first, split, True, False))
+                    row = split+1
+                    continue
+                if end >= stop:
+                    result.append((first, stop, False, False))
+                    break
+
+            if breaks is None:
+                result.append((first, end+1, True, False))
+                row = end+1
+                continue
+            after = following(breaks, end+1)
+            if after >= stop:
+                result.append((first, stop, False, True))
+                break
+            result.append((first, after, True, True))
+            row = after+1
+
+        starts, stops, done, extra = np.array(result, np.int64).reshape(-1, 4).T
+        done, extra = done.astype(bool), extra.astype(bool)
+        keep = (stops-starts >= cls.min_states) | ~done
+        return starts[keep], stops[keep], done[keep], extra[keep]
+
+    def _restore(self, extra):
+        self.ending = extra
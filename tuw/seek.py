@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+
+import numpy as np
+
+from .table import StateTable, ROOM_CODE, iter_tables, read_packets, _fingerprint
+from .archive import is_archive, read_archive
+
+#Sparse seek index stored next to each dump, for loading only the packets
+#in a timestamp range, a death count range or a room. Every STRIDE packets
+#it records the block's file offset, first sequence number and room, and
+#the range of timestamps and death counts inside it. Room changes are rare,
+#so every one of them is recorded exactly. A query reads the index (a few
+#kilobytes), then only the blocks that can match, and trims those to the
+#exact packets.
+#
+#The index records the size and mtime of the dump and a hash of the start
+#and end of the indexed bytes. A dump that has grown with those bytes
+#unchanged is indexed from the last block on, any other change rebuilds it.
+
+INDEX_VERSION = 2
+INDEX_SUFFIX = '.tuwidx'
+STRIDE = 512
+
+BLOCK_DTYPE = np.dtype([
+    ('row', np.int64), ('offset', np.int64), ('sequence', np.uint32),
+    ('timestamp_min', np.float64), ('timestamp_max', np.float64),
+    ('deaths_min', np.int32), ('deaths_max', np.int32),
+    ('room', ROOM_CODE),
+    ])
+CHANGE_DTYPE = np.dtype([('row', np.int64), ('offset', np.int64), ('room', ROOM_CODE)])
+
+def index_path(filename):
+    return filename + INDEX_SUFFIX
+
+class SeekIndex():
+    """
+    blocks holds one BLOCK_DTYPE entry per STRIDE packets (the last block
+    may be shorter), changes one CHANGE_DTYPE entry for each packet whose
+    room differs from the packet before it. rows and end are the packet
+    count and the file offset just past the last indexed packet.
+    """
+
+    def __init__(self, filename, stride = STRIDE):
+        self.filename = filename
+        self.stride = stride
+        self.blocks = np.zeros(0, BLOCK_DTYPE)
+        self.changes = np.zeros(0, CHANGE_DTYPE)
+        self.room_names = []
+        self.strings = []
+        self.rows = 0
+        self.end = 0
+        self.source = None
+
+    @classmethod
+    def load(cls, filename, stride = STRIDE):
+        """
+        Read the index for filename, building it if there is none, or
+        extending it if the dump has grown since.
+        """
+        self = cls.read(filename)
+        if self is None or self.stride != stride:
+            self = cls(filename, stride)
+
+        #unchanged, or only appended to, which keeps the packets indexed so
+        #far. Anything else is indexed again from the start.
+        stat = os.stat(filename)
+        if self.source is not None:
+            if self.source['size'] == stat.st_size and self.source['mtime'] == stat.st_mtime_ns:
+                return self
+            if not self.appended(stat):
+                self = cls(filename, stride)
+
+        self.extend()
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Couldn't write seek index for {filename}: {e}")
+        return self
+
+    def appended(self, stat):
+        """
+        Whether the dump with os.stat result stat has only grown since it
+        was indexed
+        """
+        if stat.st_size <= self.source['size'] or stat.st_size < self.end:
+            return False
+        return _fingerprint(self.filename, self.end) == self.source['prefix']
+
+    @classmethod
+    def read(cls, filename):
+        try:
+            with open(index_path(filename), 'rb') as fp:
+                data = np.load(fp, allow_pickle=False)
+                meta = json.loads(str(data['meta']))
+                if meta.get('version') != INDEX_VERSION:
+                    return None
+                self = cls(filename, meta['stride'])
+                self.blocks = data['blocks']
+                self.changes = data['changes']
+        except (OSError, ValueError, KeyError):
+            return None
+        self.room_names = [sys.intern(x) for x in meta['rooms']]
+        self.strings = meta['strings']
+        self.rows = meta['rows']
+        self.end = meta['end']
+        self.source = meta['source']
+        return self
+
+    def write(self):
+        meta = {
+            'version': INDEX_VERSION,
+            'stride': self.stride,
+            'rooms': self.room_names,
+            'strings': self.strings,
+            'rows': self.rows,
+            'end': self.end,
+            'source': self.source,
+            }
+        path = index_path(self.filename)
+        with open(path + '.tmp', 'wb') as fp:
+            np.savez(fp, blocks=self.blocks, changes=self.changes, meta=np.array(json.dumps(meta)))
+        os.replace(path + '.tmp', path)
+
+    def extend(self):
+        """
+        Index the packets appended to the dump since the index was built.
+        The last block is redone in case it wasn't full.
+        """
+        #stat first so a dump that grows while indexing reads as grown next time
+        stat = os.stat(self.filename)
+        source = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        blocks = list(self.blocks[:-1])
+        start_row, start = 0, 0
+        if len(self.blocks) > 0:
+            start_row, start = int(self.blocks[-1]['row']), int(self.blocks[-1]['offset'])
+        changes = [self.changes[self.changes['row'] < start_row]]
+        prev_room = None
+        if len(changes[0]) > 0:
+            prev_room = int(changes[0]['room'][-1])
+
+        names = list(self.room_names)
+        lookup = {x: i for i, x in enumerate(names)}
+
+        row = start_row
+        pending = None
+        end = start
+        for table in iter_tables(self.filename, start=start):
+            if row == 0 and 0 in table.strings:
+                self.strings = table.strings[0]
+            #recode the table's rooms into the index's room names
+            codes = []
+            for name in table.room_names:
+                if name not in lookup:
+                    lookup[name] = len(names)
+                    names.append(name)
+                codes.append(lookup[name])
+            room = np.array(codes + [0], dtype=np.int64)[table.room_code]
+
+            #room changes, including across the table boundary
+            first = np.ones(len(room), bool)
+            first[1:] = room[1:] != room[:-1]
+            if len(room) > 0 and prev_room is not None:
+                first[0] = room[0] != prev_room
+            if len(room) > 0:
+                prev_room = int(room[-1])
+            idx = np.flatnonzero(first)
+            entries = np.zeros(len(idx), CHANGE_DTYPE)
+            entries['row'] = row+idx
+            entries['offset'] = table.offsets[idx]
+            entries['room'] = room[idx]
+            changes.append(entries)
+
+            columns = {
+                'offset': table.offsets, 'sequence': table.sequence,
+                'timestamp': table.timestamp, 'deaths': table.deaths, 'room': room,
+                }
+            if pending is not None:
+                columns = {k: np.concatenate([pending[k], v]) for k, v in columns.items()}
+            block_row = row-(len(columns['offset'])-len(table))
+            count = len(columns['offset'])//self.stride*self.stride
+            blocks.extend(self._blocks(columns, block_row, count))
+            pending = {k: v[count:] for k, v in columns.items()}
+
+            row += len(table)
+            end = table.end
+
+        if pending is not None and len(pending['offset']) > 0:
+            blocks.extend(self._blocks(pending, row-len(pending['offset']), len(pending['offset'])))
+
+        self.blocks = np.array(blocks, dtype=BLOCK_DTYPE)
+        self.changes = np.concatenate(changes)
+        self.room_names = names
+        self.rows = row
+        self.end = max(end, start)
+        source['prefix'] = _fingerprint(self.filename, self.end)
+        self.source = source
+
+    def _blocks(self, columns, base, stop):
+        #BLOCK_DTYPE entries for the first stop rows of columns, which begin
+        #at row base of the dump
+        result = []
+        for left in range(0, stop, self.stride):
+            right = min(left+self.stride, stop)
+            result.append((
+                base+left, columns['offset'][left], columns['sequence'][left],
+                columns['timestamp'][left:right].min(), columns['timestamp'][left:right].max(),
+                columns['deaths'][left:right].min(), columns['deaths'][left:right].max(),
+                columns['room'][left],
+                ))
+        return result
+
+    def block_ranges(self, timestamps = None, deaths = None, room = None):
+        """
+        Byte and row ranges of the blocks that might hold packets matching
+        every condition given. timestamps and deaths are [low, high) pairs,
+        room a room name. Returns a list of (row start, row stop, offset
+        start, offset stop) with adjacent blocks merged.
+        """
+        blocks = self.blocks
+        match = np.ones(len(blocks), bool)
+        if timestamps is not None:
+            low, high = timestamps
+            match &= (blocks['timestamp_max'] >= low) & (blocks['timestamp_min'] < high)
+        if deaths is not None:
+            low, high = deaths
+            match &= (blocks['deaths_max'] >= low) & (blocks['deaths_min'] < high)
+        if room is not None:
+            in_room = np.zeros(len(blocks), bool)
+            if room in self.room_names:
+                code = self.room_names.index(room)
+                in_room |= blocks['room'] == code
+                in_room[self.changes['row'][self.changes['room'] == code]//self.stride] = True
+            match &= in_room
+
+        row_ends = np.append(blocks['row'][1:], self.rows)
+        offset_ends = np.append(blocks['offset'][1:], self.end)
+        result = []
+        for idx in np.flatnonzero(match).tolist():
+            start, stop = int(blocks['row'][idx]), int(row_ends[idx])
+            offset, offset_end = int(blocks['offset'][idx]), int(offset_ends[idx])
+            if len(result) > 0 and result[-1][1] == start:
+                result[-1] = (result[-1][0], stop, result[-1][2], offset_end)
+            else:
+                result.append((start, stop, offset, offset_end))
+        return result
+
+def matching_ranges(table, timestamps = None, deaths = None, room = None):
+    """
+    Row ranges [start, stop) of table where every packet matches every
+    condition given
+    """
+    match = np.ones(len(table), bool)
+    if timestamps is not None:
+        match &= (table.timestamp >= timestamps[0]) & (table.timestamp < timestamps[1])
+    if deaths is not None:
+        match &= (table.deaths >= deaths[0]) & (table.deaths < deaths[1])
+    if room is not None:
+        code = table.room_names.index(room) if room in table.room_names else -1
+        match &= table.room_code == code
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], match, [False]]).astype(np.int8)))
+    return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+def _join(tables):
+    result = StateTable()
+    result.concatenate(tables)
+    if len(tables) > 0:
+        result.filename = tables[0].filename
+    return result
+
+def load_partial(filename, timestamps = None, deaths = None, room = None):
+    """
+    Load only the packets of a dump matching every condition given (see
+    SeekIndex.block_ranges). Returns (table, pieces, strings) where pieces
+    are the row ranges of table that are contiguous in the dump and strings
+    are the dump's stream strings. Archives are read whole and trimmed.
+    """
+    if is_archive(filename):
+        table = read_archive(filename)
+        strings = table.strings.get(0, [])
+        tables = [table]
+    else:
+        index = SeekIndex.load(filename)
+        strings = index.strings
+        tables = [read_packets(filename, offset, offset_end)
+            for _, _, offset, offset_end in index.block_ranges(timestamps, deaths, room)]
+
+    pieces = []
+    selected = []
+    row = 0
+    for table in tables:
+        for start, stop in matching_ranges(table, timestamps, deaths, room):
+            selected.append(table.slice(start, stop))
+            pieces.append((row, row+stop-start))
+            row += stop-start
+    table = _join(selected)
+    table.filename = filename
+    return table, pieces, strings
@@ -0,0 +1,891 @@
+import os
+import sys
+import mmap
+import struct
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+HEADER_FIELDS = (
+    ('sequence', np.uint32),
+    ('timestamp', np.float64),
+    ('time', np.int64),
+    ('deaths', np.int32),
+    )
+
+PLAYER_FIELDS = (
+    ('xpos', np.float32), ('ypos', np.float32),
+    ('xvel', np.float32), ('yvel', np.float32),
+    ('stamina', np.float32), ('xlift', np.float32), ('ylift', np.float32),
+    ('state', np.int32),
+    ('dashes', np.int32),
+    ('control_flags', np.uint8), ('status_flags', np.uint8),
+    )
+
+INPUT_FIELDS = (
+    ('button_flags', np.uint8), ('direction_flags', np.uint8),
+    ('xaim', np.float32), ('yaim', np.float32),
+    )
+
+TRANSIENT_FIELDS = (
+    ('collection_flags', np.uint8), ('state_change_flags', np.uint8),
+    )
+
+#Field order as unpacked from a packet; direction_flags holds the raw input
+#byte here and is split into direction_flags and mark_flags afterwards
+PACKET_FIELDS = HEADER_FIELDS + PLAYER_FIELDS + INPUT_FIELDS
+
+#Columns stored for every packet
+FIELDS = PACKET_FIELDS + (('mark_flags', np.uint8),)
+
+ROOM_CODE = np.uint16
+FLAG_CODE = np.uint16
+
+#Sparse event tables, one row per packet carrying a transient or flag change
+#section, sorted by packet index
+TRANSIENT_DTYPE = np.dtype([('index', np.int64)] + list(TRANSIENT_FIELDS))
+FLAG_DTYPE = np.dtype([('index', np.int64), ('flag', FLAG_CODE), ('on', np.bool_)])
+
+HEADER = struct.Struct('=Idqi')
+#player state and input state are contiguous after the room name
+PLAYER_INPUT = struct.Struct('=fffffffiiBB' 'BBff')
+FLAG_SIZE = struct.Struct('=H')
+
+#numpy equivalents of the structs for decoding many packets at once
+HEADER_DTYPE = np.dtype(list(HEADER_FIELDS))
+PLAYER_INPUT_DTYPE = np.dtype(list(PLAYER_FIELDS + INPUT_FIELDS))
+
+def gather(raw, positions, width, chunk = 0x10000):
+    """
+    Copy width bytes starting at each of positions out of the uint8 array
+    raw into an (N, width) array. Reads past the end of raw are clamped.
+    """
+    result = np.empty((len(positions), width), np.uint8)
+    span = np.arange(width)
+    for left in range(0, len(positions), chunk):
+        idx = positions[left:left+chunk,None]+span
+        result[left:left+chunk] = raw[np.minimum(idx, len(raw)-1)]
+    return result
+
+def find_nulls(raw, starts, ends):
+    """
+    Position of the first null byte in raw[start:end] for each start, end
+    pair, or -1 if there isn't one. Steps all strings forward together, so it
+    takes as many passes as the longest string.
+    """
+    result = np.full(len(starts), -1, np.int64)
+    pending = np.arange(len(starts))
+    pos = np.array(starts, dtype=np.int64)
+    while len(pending) > 0:
+        inside = pos < ends[pending]
+        pending, pos = pending[inside], pos[inside]
+        found = raw[pos] == 0
+        result[pending[found]] = pos[found]
+        pending, pos = pending[~found], pos[~found]+1
+    return result
+
+def decode_names(raw, starts, ends):
+    """
+    Dictionary encode the ascii strings raw[start:end]. Returns (codes,
+    names) where names lists each distinct string once, in order of first
+    appearance, and codes indexes into names.
+    """
+    if len(starts) == 0:
+        return np.zeros(0, ROOM_CODE), []
+    lengths = ends-starts
+    width = max(int(lengths.max()), 1)
+    chars = gather(raw, starts, width)
+    chars[np.arange(width) >= lengths[:,None]] = 0
+    names, first, codes = np.unique(chars.view(f'S{width}')[:,0],
+        return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    remap = np.empty(len(order), np.int64)
+    remap[order] = np.arange(len(order))
+    names = [sys.intern(x.decode('ascii')) for x in names[order]]
+    return narrow_codes(remap[codes.reshape(-1)], names, ROOM_CODE), names
+
+def narrow_codes(codes, names, dtype):
+    if len(names) > np.iinfo(dtype).max+1:
+        raise ValueError(f'too many distinct names ({len(names)})')
+    return codes.astype(dtype)
+
+def merge_names(pairs):
+    """
+    Merge dictionary encoded (names, codes) pairs into one dictionary. Names
+    keep the order they first appear in, so the codes of the first pair
+    don't change. Returns (names, codes) with codes concatenated as int64.
+    """
+    names = []
+    lookup = {}
+    merged = []
+    for pair_names, codes in pairs:
+        for name in pair_names:
+            if name not in lookup:
+                lookup[name] = len(names)
+                names.append(name)
+        remap = np.array([lookup[x] for x in pair_names] + [0], dtype=np.int64)
+        merged.append(remap[codes])
+    return names, np.concatenate(merged + [np.zeros(0, np.int64)])
+
+def event_ranges(index, starts, stops):
+    """
+    For events at the sorted packet indices index, the [lo, hi) event rows
+    falling inside each packet range [start, stop)
+    """
+    return np.searchsorted(index, starts), np.searchsorted(index, stops)
+
+def range_positions(index, starts, stops):
+    """
+    For events at the sorted packet indices index, the position of the
+    packet range [start, stop) each falls in, or -1. Ranges are sorted and
+    non-overlapping.
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    pos = np.searchsorted(starts, index, 'right')-1
+    inside = pos >= 0
+    inside[inside] = index[inside] < stops[pos[inside]]
+    return np.where(inside, pos, -1)
+
+def reduce_events(index, values, starts, stops, ufunc = np.bitwise_or):
+    """
+    Reduce the event values falling inside each packet range [start, stop)
+    with ufunc. Ranges without events get 0.
+    """
+    lo, hi = event_ranges(index, np.asarray(starts), np.asarray(stops))
+    result = np.zeros(len(lo), values.dtype)
+    found = hi > lo
+    if found.any():
+        result[found] = reduce_ranges(values, lo[found], hi[found], ufunc)
+    return result
+
+def reduce_ranges(values, starts, stops, ufunc = np.bitwise_or):
+    """
+    Reduce values over each non-empty range [start, stop) with ufunc
+    """
+    if len(starts) == 0:
+        return np.zeros(0, values.dtype)
+    #reduceat over interleaved start, stop pairs reduces each [start, stop) slice
+    bounds = np.stack([starts, stops], axis=1).reshape(-1)
+    padded = np.concatenate([values, np.zeros(1, values.dtype)])
+    return ufunc.reduceat(padded, bounds)[::2]
+
+class PathMetrics():
+    """
+    Running totals along a table's packets, so the path of any range of
+    packets is measured with two lookups: squared[i] sums the squared
+    distance of each step from packet 0 to packet i, and distance sums the
+    step distances themselves. Elapsed time is just the timestamp column.
+    Totals are extended as the table grows. A difference of totals can
+    differ from summing the range directly in the last few bits.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.squared = np.zeros(0, np.float64)
+        self.distance = np.zeros(0, np.float64)
+        self.update()
+
+    def update(self):
+        count = len(self.squared)
+        if count > len(self.table):
+            count = 0
+        if count == len(self.table):
+            return
+        #step i goes from packet i-1 to i, so start from the last summed one
+        left = max(count-1, 0)
+        dx = np.diff(self.table.xpos[left:].astype(np.float64))
+        dy = np.diff(self.table.ypos[left:].astype(np.float64))
+        steps = dx*dx + dy*dy
+        for name, values in (('squared', steps), ('distance', np.sqrt(steps))):
+            totals = getattr(self, name)[:count]
+            base = totals[-1:] if count else np.zeros(1)
+            setattr(self, name, np.concatenate([totals[:-1], np.cumsum(np.concatenate([base, values]))]))
+
+    def _span(self, name, starts, stops):
+        self.update()
+        totals = getattr(self, name)
+        starts = np.asarray(starts)
+        stops = np.maximum(np.asarray(stops)-1, starts)
+        return totals[stops] - totals[starts]
+
+    def squared_length(self, starts, stops):
+        """
+        Sum of squared step distances over each packet range [start, stop),
+        for a single range or arrays of them
+        """
+        return self._span('squared', starts, stops)
+
+    def path_length(self, starts, stops):
+        """
+        Distance travelled over each packet range [start, stop)
+        """
+        return self._span('distance', starts, stops)
+
+    def duration(self, starts, stops):
+        """
+        Seconds from the first to the last packet of each range [start, stop)
+        """
+        timestamp = self.table.timestamp
+        starts = np.asarray(starts)
+        stops = np.maximum(np.asarray(stops)-1, starts)
+        return timestamp[stops] - timestamp[starts]
+
+class PacketDecoder():
+    """
+    Decodes packet payloads in place from a bytes-like buffer using
+    precompiled structs at fixed offsets, so only the fields themselves are
+    copied out. buf must support find (bytes or mmap).
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.view = memoryview(buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.view.release()
+
+    def _null(self, start, end):
+        pos = self.buf.find(b'\x00', start, end)
+        if pos < 0:
+            raise struct.error(f'unterminated string at {start}')
+        return pos
+
+    def decode(self, offset, size):
+        """
+        Decode the payload at buf[offset:offset+size]. Returns
+        (values, room, transient, flag_changes, strings) with values in
+        PACKET_FIELDS order and transient either None or
+        (collection_flags, state_change_flags).
+        """
+        buf, view = self.buf, self.view
+        end = offset+size
+
+        if size < HEADER.size:
+            raise struct.error(f'packet too short ({size} bytes)')
+        header = HEADER.unpack_from(buf, offset)
+
+        pos = offset+HEADER.size
+        room_end = self._null(pos, end)
+        room = sys.intern(str(view[pos:room_end], 'ascii'))
+
+        pos = room_end+1
+        if pos+PLAYER_INPUT.size > end:
+            raise struct.error(f'packet too short ({size} bytes)')
+        values = header + PLAYER_INPUT.unpack_from(buf, pos)
+        pos += PLAYER_INPUT.size
+
+        transient = None
+        flag_changes = []
+        while pos < end:
+            kind = buf[pos]
+            if kind == 1:
+                if pos+4 > end:
+                    raise struct.error(f'truncated transient state at {pos}')
+                transient = (buf[pos+2], buf[pos+3])
+                pos += 2+buf[pos+1]
+            elif kind == 2:
+                if pos+3 > end:
+                    raise struct.error(f'truncated flag changes at {pos}')
+                chunk_end = min(pos+FLAG_SIZE.unpack_from(buf, pos+1)[0], end)
+                pos += 3
+                while pos < chunk_end:
+                    name_end = buf.find(b'\x00', pos, chunk_end)
+                    if name_end < 0:
+                        break
+                    flag_changes.append((sys.intern(str(view[pos+1:name_end], 'ascii')), buf[pos] == 1))
+                    pos = name_end+1
+                pos = chunk_end
+            else:
+                break
+
+        #trailing text after the last null is dropped, as it always has been
+        strings = []
+        while pos < end:
+            string_end = buf.find(b'\x00', pos, end)
+            if string_end < 0:
+                break
+            strings.append(str(view[pos:string_end], 'ascii'))
+            pos = string_end+1
+
+        return values, room, transient, flag_changes, strings
+
+
+def scan_packets(buf, start = 0):
+    """
+    Walk the length prefixes in buf without decoding any payloads. Returns
+    (offsets, sizes, end) where offsets are the positions of each packet's
+    length prefix, sizes are the payload sizes and end is the position just
+    past the last complete packet.
+    """
+    #each offset depends on the size before it, so this stays a plain loop;
+    #bench_load.py times it
+    offsets = []
+    append = offsets.append
+    total = len(buf)
+    offset = start
+    while offset+2 <= total:
+        following = offset+2+(buf[offset] | (buf[offset+1] << 8))
+        if following > total:
+            break
+        append(offset)
+        offset = following
+
+    offsets = np.array(offsets, dtype=np.int64)
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    sizes = raw[offsets].astype(np.int64) | (raw[offsets+1].astype(np.int64) << 8)
+
+    return offsets, sizes, offset
+
+class PacketIndex():
+    """
+    Offsets and sizes of every packet in a dump buffer. Gives O(1) access to
+    any packet payload and can cut the dump into chunks on packet boundaries.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.offsets, self.sizes, self.end = scan_packets(buf)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        offset = int(self.offsets[idx])+2
+        return self.buf[offset:offset+int(self.sizes[idx])]
+
+    def trailing(self):
+        """
+        Number of bytes after the last complete packet
+        """
+        return len(self.buf) - self.end
+
+    def chunks(self, count):
+        """
+        Split the packets into at most count contiguous (start, stop) index
+        ranges holding roughly the same number of bytes each.
+        """
+        if len(self) == 0:
+            return []
+        bounds = np.linspace(self.offsets[0], self.end, count+1)
+        edges = np.unique(np.searchsorted(self.offsets, bounds[1:-1]))
+        edges = [0, *[int(x) for x in edges if 0 < x < len(self)], len(self)]
+        return list(zip(edges[:-1], edges[1:]))
+
+def _open_buffer(filename, use_mmap = True):
+    with open(filename, 'rb') as fp:
+        if use_mmap and os.fstat(fp.fileno()).st_size > 0:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return fp.read()
+
+def _decode_chunk(filename, offsets, sizes):
+    """
+    Process pool worker for StateTable._decode_parallel
+    """
+    buf = _open_buffer(filename)
+    table = StateTable()
+    table.decode_packets(buf, offsets, sizes)
+    if isinstance(buf, mmap.mmap):
+        buf.close()
+    return table
+
+def iter_tables(filename, block_size = 0x400000, start = 0):
+    """
+    Decode filename a block at a time, yielding a StateTable for the
+    complete packets in each block. Only one block is held in memory, so
+    this works on dumps of any size. start is the file offset of the first
+    packet to decode.
+    """
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        buf = b''
+        base = start
+        while True:
+            data = fp.read(block_size)
+            if len(data) == 0:
+                break
+            buf += data
+
+            offsets, sizes, end = scan_packets(buf)
+            if len(offsets) > 0:
+                table = StateTable()
+                table.filename = filename
+                table.decode_packets(buf, offsets, sizes, base)
+                table.end = base+end
+                yield table
+
+            base += end
+            buf = buf[end:]
+
+    if len(buf) > 0:
+        print(f'malformed packet at offset {base}? {len(buf)} trailing bytes')
+
+def read_packets(filename, start, stop):
+    """
+    Decode just the packets between file offsets start and stop, which must
+    fall on packet boundaries (e.g. values from a table's offsets/end).
+    """
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        buf = fp.read(stop-start)
+
+    offsets, sizes, end = scan_packets(buf)
+    if end < len(buf):
+        print(f'malformed packet at offset {start+end}? {len(buf)-end} trailing bytes')
+    table = StateTable()
+    table.filename = filename
+    table.decode_packets(buf, offsets, sizes, start)
+    table.end = start+end
+    return table
+
+def _fingerprint(filename, end, size = 4096):
+    #hash of the first and last size bytes of the dump before end, to tell
+    #a dump that was appended to from one that was rewritten
+    with open(filename, 'rb') as fp:
+        digest = hashlib.sha1(fp.read(min(size, end)))
+        fp.seek(max(end-size, 0))
+        digest.update(fp.read(end-max(end-size, 0)))
+    return digest.hexdigest()
+
+class MappedFile():
+    """
+    Where a read only np.memmap covering the rest of its file (like np.load
+    with mmap_mode gives) comes from, to map it again
+    """
+    def __init__(self, array):
+        self.filename = array.filename
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.offset = array.offset
+
+    @staticmethod
+    def covers(array):
+        if not isinstance(array, np.memmap) or array.filename is None or array.mode != 'r':
+            return False
+        try:
+            size = os.path.getsize(array.filename)
+        except OSError:
+            return False
+        return array.flags.c_contiguous and array.offset+array.nbytes == size
+
+    def open(self):
+        return np.memmap(self.filename, self.dtype, 'r', self.offset, self.shape)
+
+class StateTable():
+    """
+    A state dump decoded into one numpy array per field. Field names match
+    the GameState attributes, with flags stored as raw integers. Rooms are
+    dictionary encoded: room_code indexes into room_names, which lists each
+    room once in order of first appearance (names are interned, so every
+    state in a room shares one str).
+
+    The rare transient and flag change sections are kept as sparse event
+    tables sorted by packet index: transients holds (index,
+    collection_flags, state_change_flags) and flag_events holds (index,
+    flag, on) with flag indexing into flag_names. strings is a dict mapping
+    packet index to the stream strings a packet carries, and offsets holds
+    the file offset of each packet. end is the file offset just past the
+    last complete packet, where decoding would resume, and prefix is a hash
+    of the file before end for telling appends from rewrites.
+    """
+
+    def __init__(self, filename = None, use_mmap = True, workers = 1):
+        self.filename = filename
+        self.transients = np.zeros(0, TRANSIENT_DTYPE)
+        self.flag_events = np.zeros(0, FLAG_DTYPE)
+        self.flag_names = []
+        self.strings = {}
+        self.offsets = np.zeros(0, np.int64)
+        self.end = 0
+        self.prefix = None
+        self._set_columns({name: np.zeros(0, dtype) for name, dtype in FIELDS})
+        self.room_code = np.zeros(0, ROOM_CODE)
+        self.room_names = []
+        self._paths = None
+        self._buffers = {}
+
+        if filename is not None:
+            self.load(filename, use_mmap, workers)
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getstate__(self):
+        #columns mapped from a cache are pickled as a reference to the file,
+        #so a table sent to another process is mapped there too
+        state = self.__dict__.copy()
+        state['_buffers'] = {}
+        for name, value in state.items():
+            if MappedFile.covers(value):
+                state[name] = MappedFile(value)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if isinstance(value, MappedFile):
+                state[name] = value.open()
+        self.__dict__.update(state)
+
+    def _set_columns(self, columns):
+        for name, _ in FIELDS:
+            setattr(self, name, columns[name])
+
+    def columns(self):
+        return {name: getattr(self, name) for name, _ in FIELDS}
+
+    def load(self, filename, use_mmap = True, workers = 1):
+        """
+        Decode a dump file. With use_mmap the file is memory mapped instead of
+        read, so peak memory doesn't include a copy of the file. With more
+        than one worker the packets are split into chunks that are decoded in
+        a process pool; the result is identical to decoding serially.
+        """
+        buf = _open_buffer(filename, use_mmap)
+
+        if workers > 1:
+            index = PacketIndex(buf)
+            if index.trailing() > 0:
+                print(f'malformed packet at offset {index.end}? {index.trailing()} trailing bytes')
+            index.buf = None
+            self._decode_parallel(filename, index, workers)
+            self.end = index.end
+        else:
+            self.decode(buf)
+
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        self.prefix = _fingerprint(filename, self.end)
+
+    def _decode_parallel(self, filename, index, workers):
+        #a couple of chunks per worker so one slow chunk doesn't hold up the rest
+        chunks = index.chunks(workers*2)
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_decode_chunk, filename,
+                    index.offsets[start:stop], index.sizes[start:stop])
+                for start, stop in chunks]
+            tables = [x.result() for x in futures]
+        self.concatenate(tables)
+
+    def concatenate(self, tables):
+        """
+        Replace the contents of this table with tables joined end to end
+        """
+        columns = {}
+        for name, dtype in FIELDS:
+            columns[name] = np.concatenate([getattr(x, name) for x in tables] + [np.zeros(0, dtype)])
+        #merge the dictionaries, keeping codes of earlier tables stable
+        room_names, room_code = merge_names((x.room_names, x.room_code) for x in tables)
+        room_code = narrow_codes(room_code, room_names, ROOM_CODE)
+        flag_names, flag_code = merge_names((x.flag_names, x.flag_events['flag']) for x in tables)
+        flag_code = narrow_codes(flag_code, flag_names, FLAG_CODE)
+        offsets = np.concatenate([x.offsets for x in tables] + [np.zeros(0, np.int64)])
+
+        transients = []
+        flag_events = []
+        strings = {}
+        base = 0
+        for table in tables:
+            transients.append(table.transients.copy())
+            transients[-1]['index'] += base
+            flag_events.append(table.flag_events.copy())
+            flag_events[-1]['index'] += base
+            strings.update({base+k: v for k, v in table.strings.items()})
+            base += len(table)
+        transients = np.concatenate(transients + [np.zeros(0, TRANSIENT_DTYPE)])
+        flag_events = np.concatenate(flag_events + [np.zeros(0, FLAG_DTYPE)])
+        flag_events['flag'] = flag_code
+
+        self._set_columns(columns)
+        self.room_code = room_code
+        self.room_names = room_names
+        self.offsets = offsets
+        self.transients = transients
+        self.flag_events = flag_events
+        self.flag_names = flag_names
+        self.strings = strings
+        if len(tables) > 0:
+            self.end = tables[-1].end
+
+    def append(self, other):
+        """
+        Add the rows of other to the end of this table in place. Each column
+        is a view of a buffer with room to spare, so a table that keeps
+        growing (see refresh) doesn't copy every column on every append.
+        """
+        base = len(self)
+        #the empty codes just put this table's names first
+        room_names, room_code = merge_names([(self.room_names, np.zeros(0, np.int64)),
+            (other.room_names, other.room_code)])
+        flag_names, flag_code = merge_names([(self.flag_names, np.zeros(0, np.int64)),
+            (other.flag_names, other.flag_events['flag'])])
+
+        for name, _ in FIELDS:
+            self._grow(name, getattr(other, name))
+        self._grow('room_code', narrow_codes(room_code, room_names, ROOM_CODE))
+        self._grow('offsets', other.offsets)
+        transients = other.transients.copy()
+        transients['index'] += base
+        self._grow('transients', transients)
+        flag_events = other.flag_events.copy()
+        flag_events['index'] += base
+        flag_events['flag'] = narrow_codes(flag_code, flag_names, FLAG_CODE)
+        self._grow('flag_events', flag_events)
+
+        self.room_names = room_names
+        self.flag_names = flag_names
+        self.strings.update({base+k: v for k, v in other.strings.items()})
+        self.end = other.end
+
+    def _grow(self, name, values):
+        #append values to the array attribute name, which is kept as the
+        #first rows of a buffer that doubles in size when it fills up
+        column = getattr(self, name)
+        count = len(column)+len(values)
+        buffer = self._buffers.get(name)
+        if buffer is None or column.base is not buffer or len(buffer) < count:
+            buffer = np.empty(max(count, 2*len(column)), column.dtype)
+            buffer[:len(column)] = column
+            self._buffers[name] = buffer
+        buffer[len(column):count] = values
+        setattr(self, name, buffer[:count])
+
+    def slice(self, start, stop):
+        """
+        New table holding rows [start, stop). Columns are views into this
+        table's columns.
+        """
+        result = StateTable()
+        result.filename = self.filename
+        result._set_columns({name: x[start:stop] for name, x in self.columns().items()})
+        result.room_code = self.room_code[start:stop]
+        result.room_names = self.room_names
+        result.offsets = self.offsets[start:stop]
+        for name in ('transients', 'flag_events'):
+            lo, hi = event_ranges(getattr(self, name)['index'], start, stop)
+            events = getattr(self, name)[lo:hi].copy()
+            events['index'] -= start
+            setattr(result, name, events)
+        result.flag_names = self.flag_names
+        result.strings = {k-start: v for k, v in self.strings.items() if start <= k < stop}
+        result.end = self.end
+        return result
+
+    def refresh(self):
+        """
+        Decode any complete packets appended to the file since the last load
+        or refresh, and append them to the table. A partially written packet
+        at the end is left for the next refresh. A file that was rewritten
+        rather than appended to is loaded again from the start. Returns the
+        first row that is new or changed, len(self) if none are.
+        """
+        if os.path.getsize(self.filename) < self.end or (self.prefix is not None
+                and _fingerprint(self.filename, self.end) != self.prefix):
+            print(f'{self.filename} was rewritten, loading it again')
+            self._buffers = {}
+            self._paths = None
+            self.load(self.filename)
+            return 0
+
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self.end)
+            buf = fp.read()
+
+        offsets, sizes, end = scan_packets(buf)
+        if len(offsets) == 0:
+            return len(self)
+        start = len(self)
+
+        new = StateTable()
+        new.decode_packets(buf, offsets, sizes, self.end)
+        new.end = self.end+end
+        self.append(new)
+        self.prefix = _fingerprint(self.filename, self.end)
+        return start
+
+    def decode(self, buf, index = None):
+        if index is None:
+            index = PacketIndex(buf)
+        if index.trailing() > 0:
+            print(f'malformed packet at offset {index.end}? {index.trailing()} trailing bytes')
+
+        self.decode_packets(buf, index.offsets, index.sizes)
+        self.end = index.end
+
+    def decode_packets(self, buf, offsets, sizes, base = 0):
+        """
+        Decode the packets whose length prefixes are at offsets in buf, where
+        buf starts at file offset base. The fixed
+        header, player and input fields are gathered for all packets at once
+        from a numpy view of buf; only packets carrying transient, flag or
+        string sections go through PacketDecoder.
+        """
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        starts = offsets+2
+        ends = starts+sizes
+
+        room_starts = starts+HEADER.size
+        room_ends = find_nulls(raw, room_starts, ends)
+        fixed_ends = room_ends+1+PLAYER_INPUT.size
+        valid = (sizes >= HEADER.size) & (room_ends >= 0) & (fixed_ends <= ends)
+        for idx in np.flatnonzero(~valid).tolist():
+            print(f'malformed packet at offset {base+offsets[idx]}? packet too short ({sizes[idx]} bytes)')
+        extra = np.flatnonzero(valid & (fixed_ends < ends))
+
+        transients = {}
+        flag_changes = {}
+        strings = {}
+        with PacketDecoder(buf) as decoder:
+            for idx in extra.tolist():
+                try:
+                    _, _, transient, _flag_changes, _strings = decoder.decode(
+                        int(starts[idx]), int(sizes[idx]))
+                except (struct.error, ValueError) as e:
+                    print(f'malformed packet at offset {base+offsets[idx]}? {e}')
+                    valid[idx] = False
+                    continue
+                if transient is not None:
+                    transients[idx] = transient
+                if len(_flag_changes) > 0:
+                    flag_changes[idx] = _flag_changes
+                if len(_strings) > 0:
+                    strings[idx] = _strings
+
+        #renumber the sparse entries to skip malformed packets
+        rows = np.cumsum(valid)-1
+        self.strings = {int(rows[k]): v for k, v in strings.items() if valid[k]}
+        self._set_events(
+            [(int(rows[k]), *v) for k, v in transients.items() if valid[k]],
+            [(int(rows[k]), x) for k, v in flag_changes.items() if valid[k] for x in v])
+
+        starts, room_starts, room_ends = starts[valid], room_starts[valid], room_ends[valid]
+        self.offsets = offsets[valid]+base
+
+        columns = {}
+        header = gather(raw, starts, HEADER.size).view(HEADER_DTYPE)[:,0]
+        player_input = gather(raw, room_ends+1, PLAYER_INPUT.size).view(PLAYER_INPUT_DTYPE)[:,0]
+        for packed in (header, player_input):
+            for name in packed.dtype.names:
+                columns[name] = np.ascontiguousarray(packed[name])
+
+        self.room_code, self.room_names = decode_names(raw, room_starts, room_ends)
+        del raw
+
+        self._build(columns)
+
+    def _set_events(self, transients, flag_changes):
+        #transients are (index, collection, state_change), flag_changes are
+        #(index, (name, on)), both in packet order
+        self.transients = np.array(transients, dtype=TRANSIENT_DTYPE)
+
+        self.flag_names = []
+        lookup = {}
+        codes = []
+        for idx, (name, on) in flag_changes:
+            if name not in lookup:
+                lookup[name] = len(self.flag_names)
+                self.flag_names.append(name)
+            codes.append(lookup[name])
+        self.flag_events = np.zeros(len(codes), FLAG_DTYPE)
+        if len(codes) > 0:
+            self.flag_events['index'] = [x[0] for x in flag_changes]
+            self.flag_events['flag'] = narrow_codes(np.array(codes), self.flag_names, FLAG_CODE)
+            self.flag_events['on'] = [x[1][1] for x in flag_changes]
+
+    def _build(self, columns):
+        directions = columns['direction_flags']
+        columns['direction_flags'] = directions&0xf
+        columns['mark_flags'] = directions>>4
+
+        self._set_columns(columns)
+
+    @property
+    def room(self):
+        """
+        Room name of every packet as an object array
+        """
+        return np.array(self.room_names, dtype=object)[self.room_code]
+
+    def room_changes(self):
+        """
+        Indices of the packets whose room differs from the packet before
+        """
+        return np.flatnonzero(self.room_code[1:] != self.room_code[:-1])+1
+
+    def transient_flags(self, name, starts, stops):
+        """
+        OR of the transient column name (collection_flags or
+        state_change_flags) over each packet range [start, stop)
+        """
+        return reduce_events(self.transients['index'], self.transients[name], starts, stops)
+
+    def flag_changes(self, start = 0, stop = None):
+        """
+        Dict mapping packet index to the list of (name, on) flag changes for
+        the packets in [start, stop) that have any
+        """
+        if stop is None:
+            stop = len(self)
+        lo, hi = event_ranges(self.flag_events['index'], start, stop)
+        result = {}
+        events = self.flag_events[lo:hi]
+        for idx, flag, on in zip(events['index'].tolist(), events['flag'].tolist(), events['on'].tolist()):
+            result.setdefault(idx, []).append((self.flag_names[flag], on))
+        return result
+
+    def paths(self):
+        """
+        PathMetrics of the table's packets, built on first use
+        """
+        if self._paths is None:
+            self._paths = PathMetrics(self)
+        return self._paths
+
+    def row(self, idx):
+        """
+        rows() for the single packet idx, without converting a whole chunk
+        """
+        #ndarray.item skips the memmap __getitem__ and numpy scalars
+        values = [np.ndarray.item(getattr(self, name), idx) for name, _ in FIELDS]
+        transients = self.transients
+        lo = transients['index'].searchsorted(idx)
+        if lo < len(transients) and transients['index'][lo] == idx:
+            values.extend(transients[lo].item()[1:])
+        else:
+            values.extend(0 for _ in TRANSIENT_FIELDS)
+        room = self.room_names[np.ndarray.item(self.room_code, idx)]
+        flag_changes = None
+        lo = self.flag_events['index'].searchsorted(idx)
+        if lo < len(self.flag_events) and self.flag_events['index'][lo] == idx:
+            flag_changes = self.flag_changes(idx, idx+1)[idx]
+        return idx, room, values, flag_changes
+
+    def rows(self, start = 0, stop = None, chunk = 0x4000):
+        """
+        Yield (index, room, values, flag_changes) for each packet in [start,
+        stop), where values are python scalars in FIELDS order followed by
+        TRANSIENT_FIELDS, and flag_changes is a list of (name, on) or None.
+        Columns are converted a chunk at a time so iterating doesn't go
+        through numpy scalars.
+        """
+        if stop is None:
+            stop = len(self)
+        columns = [getattr(self, name) for name, _ in FIELDS]
+        for left in range(start, stop, chunk):
+            right = min(left+chunk, stop)
+
+            #expand the sparse transients over just this chunk
+            lo, hi = event_ranges(self.transients['index'], left, right)
+            events = self.transients[lo:hi]
+            chunk_columns = [x[left:right] for x in columns]
+            for name, dtype in TRANSIENT_FIELDS:
+                column = np.zeros(right-left, dtype)
+                column[events['index']-left] = events[name]
+                chunk_columns.append(column)
+            flag_changes = self.flag_changes(left, right)
+
+            values = zip(*[x.tolist() for x in chunk_columns])
+            rooms = [self.room_names[x] for x in self.room_code[left:right].tolist()]
+            for idx, (room, row) in enumerate(zip(rooms, values), left):
+                yield idx, room, row, flag_changes.get(idx)
@@ -1,8 +1,13 @@
-import os, sys
-import struct
+import math
 import enum
 
-from collections import defaultdict
+import numpy as np
+
+from .table import StateTable, PacketDecoder, iter_tables, event_ranges, reduce_ranges
+from .cache import load_table
+from .archive import is_archive, read_archive, iter_archive
+from .seek import load_partial
+from .index import TableIndex
 
 class ControlFlags(enum.Flag):
     dead = 128
@@ -83,8 +88,71 @@ class PlayerState(enum.Enum):
     cassette_fly = 21
     attract = 22
 
+class _EnumCache(dict):
+    """
+    Memoizes enum construction by raw value
+    """
+    def __init__(self, enum_class):
+        self.enum_class = enum_class
+
+    def __missing__(self, value):
+        try:
+            result = self.enum_class(value)
+        except ValueError:
+            if self.enum_class is not PlayerState:
+                raise
+            result = value
+        self[value] = result
+        return result
+
+_control_flags = _EnumCache(ControlFlags)
+_status_flags = _EnumCache(StatusFlags)
+_button_flags = _EnumCache(ButtonFlags)
+_direction_flags = _EnumCache(DirectionFlags)
+_collection_flags = _EnumCache(CollectionFlags)
+_state_change_flags = _EnumCache(StateChangeFlags)
+_player_state = _EnumCache(PlayerState)
+
+class _EnumView():
+    """
+    Exposes a raw integer attribute as an enum, built when it's read. Setting
+    it takes either an enum or an int and stores the raw value.
+    """
+    def __init__(self, raw, cache):
+        self.raw = raw
+        self.cache = cache
+
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self
+        return self.cache[getattr(obj, self.raw)]
+
+    def __set__(self, obj, value):
+        if isinstance(value, enum.Enum):
+            value = value.value
+        setattr(obj, self.raw, value)
+
+#Raw bit masks for hot loops, so they can test flags on the integer
+#attributes instead of going through the enums
+CONTROL_DEAD = ControlFlags.dead.value
+CONTROL_PAUSED = ControlFlags.paused.value
+CONTROL_GRAVITY_INVERTED = ControlFlags.gravity_inverted.value
+STATUS_CROUCHED = StatusFlags.crouched.value
+STATE_CHANGE_SPAWN = StateChangeFlags.spawn.value
+STATE_CHANGE_FLAG = StateChangeFlags.flag.value
+STATE_CHANGE_RESPAWN = StateChangeFlags.respawn_change.value
+
 class GameState():
+    """
+    A single decoded packet. Flags and the player state are stored as raw
+    integers (control, status, buttons, directions, collection,
+    state_change, player_state); the enum attributes (control_flags,
+    state, ...) are views over them. flag_changes and strings are shared
+    empty tuples on the many packets that don't carry any. index is the row
+    of the state in the StateTable it came from, or None.
+    """
     __slots__ = (
+        'index',
         'sequence',
         'timestamp',
         'time',
@@ -93,107 +161,481 @@ class GameState():
         'xpos', 'ypos',
         'xvel', 'yvel',
         'stamina', 'xlift', 'ylift',
-        'state',
+        'player_state',
         'dashes',
-        'control_flags', 'status_flags',
-        'button_flags', 'direction_flags',
+        'control', 'status',
+        'buttons', 'directions',
         'mark_flags',
         'xaim', 'yaim',
-        'collection_flags', 'state_change_flags',
+        'collection', 'state_change',
         'flag_changes',
         'strings',
         )
-    def __init__(self, raw):
-        self.sequence, self.timestamp, self.time, self.deaths = struct.unpack('=Idqi', raw[:24])
-        raw = raw[24:]
 
-        room, raw = raw.split(b'\x00', maxsplit=1)
-        self.room = room.decode('ascii')
+    state = _EnumView('player_state', _player_state)
+    control_flags = _EnumView('control', _control_flags)
+    status_flags = _EnumView('status', _status_flags)
+    button_flags = _EnumView('buttons', _button_flags)
+    direction_flags = _EnumView('directions', _direction_flags)
+    collection_flags = _EnumView('collection', _collection_flags)
+    state_change_flags = _EnumView('state_change', _state_change_flags)
 
-        player_state_fmt = '=fffffffiiBB'
-        size = struct.calcsize(player_state_fmt)
-        (   self.xpos, self.ypos, self.xvel, self.yvel,
+    def __init__(self, raw):
+        with PacketDecoder(raw) as decoder:
+            values, room, transient, flag_changes, strings = decoder.decode(0, len(raw))
+        *values, directions, xaim, yaim = values
+        if transient is None:
+            transient = (0, 0)
+        self.index = None
+        self._set(
+            (*values, directions&0xf, xaim, yaim, directions>>4, *transient),
+            room, flag_changes or (), strings or ())
+
+    def _set(self, values, room, flag_changes, strings):
+        (   self.sequence, self.timestamp, self.time, self.deaths,
+            self.xpos, self.ypos, self.xvel, self.yvel,
             self.stamina, self.xlift, self.ylift,
-            state, self.dashes, control, status) = struct.unpack(player_state_fmt, raw[:size])
-        self.control_flags = ControlFlags(control)
-        self.status_flags = StatusFlags(status)
-        try:
-            self.state = PlayerState(state)
-        except ValueError:
-            self.state = state
-        raw = raw[size:]
-
-        input_state_fmt = '=BBff'
-        size = struct.calcsize(input_state_fmt)
-        (buttons, directions, self.xaim, self.yaim) = struct.unpack(input_state_fmt, raw[:size])
-        self.button_flags = ButtonFlags(buttons)
-        self.direction_flags = DirectionFlags(directions&0xf)
-        self.mark_flags = directions>>4
-        raw = raw[size:]
-
-        self.collection_flags = CollectionFlags(0)
-        self.state_change_flags = StateChangeFlags(0)
-        self.flag_changes = []
-
-        while len(raw) > 0:
-            if raw[0] == 1:
-                size = int(raw[1])
-                raw = raw[2:]
-                self.collection_flags = CollectionFlags(int(raw[0]))
-                self.state_change_flags = StateChangeFlags(int(raw[1]))
-                raw = raw[size:]
-            elif raw[0] == 2:
-                size = struct.unpack('=H', raw[1:3])[0]
-                chunk, raw = raw[3:size], raw[size:]
-                chunks = chunk.split(b'\x00')[:-1]
-                for chunk in chunks:
-                    fc = (chunk[1:].decode('ascii'), not (int(chunk[0])-1))
-                    self.flag_changes.append(fc)
-            else:
-                break
-        self.strings = [x.decode('ascii') for x in raw.split(b'\x00')][:-1]
+            self.player_state, self.dashes, self.control, self.status,
+            self.buttons, self.directions, self.xaim, self.yaim,
+            self.mark_flags, self.collection, self.state_change) = values
+        self.room = room
+        self.flag_changes = flag_changes
+        self.strings = strings
+
+    @classmethod
+    def from_table(cls, table, idx):
+        _, room, values, flag_changes = table.row(idx)
+        self = cls.__new__(cls)
+        self.index = idx
+        self._set(values, room,
+            flag_changes or (),
+            list(table.strings[idx]) if idx in table.strings else ())
+        return self
+
+    @classmethod
+    def iter_table(cls, table, start = 0, stop = None, base = 0):
+        """
+        Build GameStates for packets [start, stop) of a StateTable. base is
+        added to their index, for a table that starts at row base of a dump.
+        """
+        strings = table.strings
+        for idx, room, values, flag_changes in table.rows(start, stop):
+            self = cls.__new__(cls)
+            self.index = base+idx
+            self._set(values, room,
+                flag_changes or (),
+                list(strings[idx]) if idx in strings else ())
+            yield self
+
+class StateList():
+    """
+    Read-only sequence of the GameStates for rows [start, stop) of a
+    StateTable, by default the whole table even as it grows. States are
+    built on access and not cached, so iterating a long dump doesn't keep
+    every state alive at once. The exception is the first state, which is
+    what runs are compared and sorted by.
+    """
+    def __init__(self, table, start = 0, stop = None):
+        self.table = table
+        self.start = start
+        self._stop = stop
+        self._first = None
+
+    @property
+    def stop(self):
+        return len(self.table) if self._stop is None else self._stop
+
+    def __len__(self):
+        return self.stop-self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return list(GameState.iter_table(self.table, self.start+start, self.start+max(start, stop)))
+            return [self[x] for x in range(start, stop, step)]
+
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('state index out of range')
+        if idx == 0:
+            if self._first is None:
+                self._first = GameState.from_table(self.table, self.start)
+            return self._first
+        return GameState.from_table(self.table, self.start+idx)
+
+    def __iter__(self):
+        return GameState.iter_table(self.table, self.start, self.stop)
+
+    def column(self, name):
+        """
+        The table column name over these rows
+        """
+        return getattr(self.table, name)[self.start:self.stop]
 
 class StateDump():
-    def __init__(self, filename):
-        self.states = []
-        self.rooms = set()
-        with open(filename, 'rb') as fp:
-            while True:
-                try:
-                    size_raw = fp.read(2)
-                    if len(size_raw) == 0:
-                        break
-
-                    size = struct.unpack('=H', size_raw)[0]
-
-                    raw = fp.read(size)
-                    state = GameState(raw)
-                    self.states.append(state)
-
-                    self.rooms.add(state.room)
-                except struct.error as e:
-                    print(f'malformed packet? {e}')
-                    pass
-                except Exception as e:
-                    raise
-
-        self.chapter = self.states[0].strings[0]
-        self.map = self.states[0].strings[1]
+    """
+    A dump loaded into a StateTable. Passing timestamps or deaths ([low,
+    high) pairs) or room loads only the packets matching all of them through
+    the dump's seek index. The loaded packets are then not contiguous in the
+    dump: pieces lists the row ranges that are, and sequences never span two
+    pieces. Sequences at the edges of a piece can differ from a full load;
+    e.g. a full load never gives a RoomRun the state that ended the run
+    before it, which is the first state of a room-only piece.
+    """
+    def __init__(self, filename, use_mmap = True, cache = True, workers = 1,
+                    timestamps = None, deaths = None, room = None):
+        #compressed archives are read directly, they load faster than a cache
+        self.archive = is_archive(filename)
+        self.partial = timestamps is not None or deaths is not None or room is not None
+        if self.partial:
+            self.table, self.pieces, strings = load_partial(filename, timestamps, deaths, room)
+        else:
+            if self.archive:
+                self.table = read_archive(filename)
+            elif cache:
+                self.table = load_table(filename, use_mmap, workers)
+            else:
+                self.table = StateTable(filename, use_mmap, workers)
+            self.pieces = [(0, len(self.table))]
+        self.states = StateList(self.table)
+        self.index = TableIndex(self.table)
+        self.rooms = set(self.table.room_names)
+
+        if not self.partial:
+            strings = self.states[0].strings
+        self.chapter = strings[0]
+        self.map = strings[1]
+
+        self.followers = []
+
+    def state_at_time(self, timestamp):
+        """
+        The earliest state at or after timestamp, or None
+        """
+        idx = self.index.at_time(timestamp)
+        return None if idx is None else self.states[idx]
+
+    def state_for_sequence(self, sequence):
+        idx = self.index.for_sequence(sequence)
+        return None if idx is None else self.states[idx]
+
+    def death_states(self, deaths):
+        """
+        The first and last states with death count deaths, or None
+        """
+        rows = self.index.for_deaths(deaths)
+        return None if rows is None else (self.states[rows[0]], self.states[rows[1]])
 
     def extract_sequences(self, SequenceClass):
         result = []
-        seq = SequenceClass()
-        for state in self.states:
+        for start, stop in self.pieces:
+            result.extend(segment_table(self.table, SequenceClass, start, stop))
+        return result
+
+    def extract_many(self, classes):
+        """
+        extract_sequences for each of classes at once, sharing the work
+        between them (see segment_many). Returns a list of results in the
+        same order.
+        """
+        results = [[] for _ in classes]
+        for start, stop in self.pieces:
+            for result, sequences in zip(results, segment_many(self.table, classes, start, stop)):
+                result.extend(sequences)
+        return results
+
+    def follow(self, SequenceClass):
+        """
+        Like extract_sequences, but the returned list is kept up to date by
+        refresh() as the dump grows.
+        """
+        follower = SequenceFollower(SequenceClass)
+        for idx, (start, stop) in enumerate(self.pieces):
+            if idx > 0:
+                follower.restart()
+            follower.feed_table(self.table, start, stop)
+        self.followers.append(follower)
+        return follower.sequences
+
+    def refresh(self):
+        """
+        Load states appended to the dump since it was loaded, for following a
+        dump that is still being written. Lists returned by follow() get the
+        new sequences. A dump that was rewritten is loaded again and the
+        lists start over. Returns the number of new states.
+        """
+        if self.archive or self.partial:
+            return 0
+        start = self.table.refresh()
+        count = len(self.table)-start
+        if count == 0:
+            return 0
+        self.pieces = [(0, len(self.table))]
+
+        if start == 0:
+            self.states = StateList(self.table)
+            self.index = TableIndex(self.table)
+            self.rooms = set()
+            for follower in self.followers:
+                del follower.sequences[:]
+                follower.restart()
+        self.rooms.update(self.table.room_names)
+        for follower in self.followers:
+            follower.feed_table(self.table, start)
+        return count
+
+class SequenceFollower():
+    """
+    Incremental extract_sequences. After each feed, sequences holds what
+    extract_sequences would return for all the states fed so far, including
+    the unfinished last sequence if it is already valid.
+    """
+    def __init__(self, SequenceClass):
+        self.SequenceClass = SequenceClass
+        self.sequences = []
+        self.seq = SequenceClass()
+
+    def restart(self):
+        #the next states fed don't follow on from the last ones
+        self.seq = self.SequenceClass()
+
+    def feed(self, states):
+        feed_all([self], states)
+
+    def feed_table(self, table, start = 0, stop = None):
+        """
+        feed() the packets [start, stop) of a StateTable. Only the packets
+        continuing an unfinished sequence of states are fed one at a time, the
+        rest go through segment_table.
+        """
+        if stop is None:
+            stop = len(table)
+        if _segmenter(self.SequenceClass) is None:
+            self.feed(GameState.iter_table(table, start, stop))
+            return
+
+        if len(self.sequences) > 0 and self.sequences[-1] is self.seq:
+            self.sequences.pop()
+
+        if isinstance(self.seq.states, StateList) and self.seq.states.table is table:
+            #a view is cheaper to segment again along with the new packets
+            start = self.seq.states.start
+        elif len(self.seq.states) > 0:
+            for state in GameState.iter_table(table, start, stop):
+                start += 1
+                self.seq.add_state(state)
+                if self.seq.done:
+                    break
+            if self.seq.valid():
+                self.sequences.append(self.seq)
+            if not self.seq.done:
+                return
+            self.seq = self.SequenceClass()
+
+        sequences, self.seq = _segment_table(table, self.SequenceClass, start, stop)
+        self.sequences.extend(sequences)
+
+def feed_all(followers, states):
+    """
+    SequenceFollower.feed for several followers, going through the states
+    once
+    """
+    #unfinished sequences are re-added below if they're still valid
+    for follower in followers:
+        if len(follower.sequences) > 0 and follower.sequences[-1] is follower.seq:
+            follower.sequences.pop()
+
+    for state in states:
+        for follower in followers:
+            seq = follower.seq
             seq.add_state(state)
             if seq.done:
                 if seq.valid():
-                    result.append(seq)
-                seq = SequenceClass()
+                    follower.sequences.append(seq)
+                follower.seq = follower.SequenceClass()
 
-        if (len(result) == 0 or result[-1] != seq) and seq.valid():
-            result.append(seq)
+    for follower in followers:
+        if follower.seq.valid():
+            follower.sequences.append(follower.seq)
 
-        return result
+def segment_arrays(starts, stops, done, extra):
+    """
+    segment_rows result from the starts, stops, done and extra of every
+    sequence. Finished single packet sequences are left out.
+    """
+    starts, stops = np.asarray(starts, np.int64), np.asarray(stops, np.int64)
+    done, extra = np.asarray(done, bool), np.asarray(extra, bool)
+    keep = (stops-starts > 1) | ~done
+    return starts[keep], stops[keep], done[keep], extra[keep]
+
+def _segmenter(SequenceClass):
+    """
+    SequenceClass.segment_rows if it gives the same sequences as add_state,
+    i.e. add_state hasn't been overridden since segment_rows was defined
+    """
+    for cls in SequenceClass.__mro__:
+        if 'segment_rows' in vars(cls):
+            if cls is StateSequence or SequenceClass.add_state is not cls.add_state:
+                return None
+            if SequenceClass._add_state is not StateSequence._add_state:
+                return None
+            return SequenceClass.segment_rows
+    return None
+
+def _row_marks(table, start, stop):
+    #rows of the dead packets and of the packets changing room in [start, stop)
+    dead = np.flatnonzero(table.control_flags[start:stop] & CONTROL_DEAD)+start
+    room_code = table.room_code
+    changes = np.flatnonzero(room_code[start+1:stop] != room_code[start:stop-1])+start+1
+    return dead, changes
+
+def _build_sequences(SequenceClass, table, starts, stops, marks = None):
+    """
+    SequenceClass instances viewing the packets [starts, stops) of table,
+    with everything _add_state would have worked out computed for all of
+    them at once from the table's columns and events. Ranges must be
+    sorted and non-overlapping. marks is _row_marks over rows covering all
+    the ranges, if already found.
+    """
+    if len(starts) == 0:
+        return []
+    control = reduce_ranges(table.control_flags, starts, stops).tolist()
+    mark_flags = reduce_ranges(table.mark_flags, starts, stops).tolist()
+    collection = table.transient_flags('collection_flags', starts, stops).tolist()
+    state_change = table.transient_flags('state_change_flags', starts, stops).tolist()
+
+    if marks is None:
+        marks = _row_marks(table, int(starts[0]), int(stops[-1]))
+    dead, changes = marks
+    idx = np.searchsorted(dead, starts)
+    first_dead = np.append(dead, stops[-1])[idx]
+    first_dead = np.where(first_dead < stops, first_dead-starts, -1).tolist()
+
+    room_code = table.room_code
+    change_lo, change_hi = event_ranges(changes, starts+1, stops)
+    change_codes = room_code[changes].tolist()
+    start_codes = room_code[starts].tolist()
+
+    flag_lo, flag_hi = event_ranges(table.flag_events['index'], starts, stops)
+
+    result = []
+    for idx, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        seq = SequenceClass()
+        seq.states = StateList(table, start, stop)
+
+        codes = [start_codes[idx]] + change_codes[change_lo[idx]:change_hi[idx]]
+        seq.room_order = [table.room_names[x] for x in codes]
+        seq.rooms = set(seq.room_order)
+        seq.control = control[idx]
+        seq.collection = collection[idx]
+        seq.state_change = state_change[idx]
+        seq.mark_flags = mark_flags[idx]
+        if first_dead[idx] >= 0:
+            seq.death_state_index = first_dead[idx]
+        if flag_hi[idx] > flag_lo[idx]:
+            seq.flag_changes = FlagSet._from_events(table.flag_names,
+                table.flag_events[flag_lo[idx]:flag_hi[idx]])
+        result.append(seq)
+    return result
+
+def _segment_table(table, SequenceClass, start, stop, marks = None):
+    """
+    Segment packets [start, stop) of table. Returns the valid sequences,
+    including an unfinished last one, and the sequence the packets after
+    stop would be added to.
+    """
+    segment_rows = _segmenter(SequenceClass)
+    if segment_rows is None:
+        follower = SequenceFollower(SequenceClass)
+        follower.feed(GameState.iter_table(table, start, stop))
+        return follower.sequences, follower.seq
+
+    starts, stops, done, extra = segment_rows(table, start, stop)
+    sequences = _build_sequences(SequenceClass, table, starts, stops, marks)
+    for seq, seq_done, seq_extra in zip(sequences, done.tolist(), extra.tolist()):
+        seq.done = seq_done
+        seq._restore(seq_extra)
+
+    current = SequenceClass()
+    if len(sequences) > 0 and not sequences[-1].done:
+        current = sequences[-1]
+    return [x for x in sequences if x.valid()], current
+
+def segment_table(table, SequenceClass, start = 0, stop = None):
+    """
+    segment_states for the packets [start, stop) of a StateTable. Sequence
+    classes with a segment_rows are segmented from the table's columns
+    instead of state by state.
+    """
+    if stop is None:
+        stop = len(table)
+    return _segment_table(table, SequenceClass, start, stop)[0]
+
+def segment_many(table, classes, start = 0, stop = None):
+    """
+    segment_table for each of classes, returning a list of results in the
+    same order. The dead packets and room changes are found once for all of
+    them, and the classes fed state by state share one pass building the
+    states.
+    """
+    if stop is None:
+        stop = len(table)
+    marks = _row_marks(table, start, stop)
+    results = {}
+    followers = []
+    for SequenceClass in classes:
+        if SequenceClass in results:
+            continue
+        if _segmenter(SequenceClass) is None:
+            follower = SequenceFollower(SequenceClass)
+            followers.append(follower)
+            results[SequenceClass] = follower.sequences
+        else:
+            results[SequenceClass] = _segment_table(table, SequenceClass, start, stop, marks)[0]
+
+    if len(followers) > 0:
+        feed_all(followers, GameState.iter_table(table, start, stop))
+    return [results[x] for x in classes]
+
+def segment_states(states, SequenceClass):
+    """
+    Split an iterable of states into valid SequenceClass instances, yielding
+    each one as soon as it is done.
+    """
+    last = None
+    seq = SequenceClass()
+    for state in states:
+        seq.add_state(state)
+        if seq.done:
+            if seq.valid():
+                last = seq
+                yield seq
+            seq = SequenceClass()
+
+    if last is not seq and seq.valid():
+        yield seq
+
+def iter_states(filename):
+    """
+    Generator over the GameStates in a dump or archive that reads the file a
+    block at a time instead of loading it all. States are indexed by their
+    row in the whole dump, like a loaded table's.
+    """
+    tables = iter_archive(filename) if is_archive(filename) else iter_tables(filename)
+    base = 0
+    for table in tables:
+        yield from GameState.iter_table(table, base=base)
+        base += len(table)
+
+def iter_sequences(filename, SequenceClass):
+    """
+    Streaming version of StateDump.extract_sequences. Finished sequences are
+    yielded while the file is still being read, so memory is bounded by the
+    longest sequence rather than the whole dump.
+    """
+    return segment_states(iter_states(filename), SequenceClass)
 
 class FlagSet():
     def __init__(self):
@@ -228,6 +670,22 @@ class FlagSet():
         self._merge(self.flags_set, other.flags_set)
         self._merge(self.flags_cleared, other.flags_cleared)
 
+    @staticmethod
+    def _count(names, codes):
+        #counts keyed by name in order of first appearance, like add_flag
+        found, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return {names[x]: y for x, y in zip(found[order].tolist(), counts[order].tolist())}
+
+    @classmethod
+    def _from_events(cls, names, events):
+        self = cls()
+        codes, on = events['flag'], events['on']
+        self.flags_changed = self._count(names, codes)
+        self.flags_set = self._count(names, codes[on])
+        self.flags_cleared = self._count(names, codes[~on])
+        return self
+
 class StateSequence():
     """
     A sequence of states with logic for segmenting and validation. Pass as an
@@ -237,20 +695,30 @@ class StateSequence():
     it terminates the sequence.
 
     valid() returns False if the sequence is not valid and should be discarded
+
+    Like GameState, the OR'ed flags are kept as raw integers (control,
+    collection, state_change) with enum views on top.
+
+    Sequences from segment_table hold a StateList view of their rows
+    instead of a list, so their states are only built when used. Adding
+    a state turns the view into a list.
     """
 
+    control_flags = _EnumView('control', _control_flags)
+    collection_flags = _EnumView('collection', _collection_flags)
+    state_change_flags = _EnumView('state_change', _state_change_flags)
+
     def __init__(self):
         self.states = []
         self.done = False
 
-        self.death_state = None
         self.death_state_index = -1
 
         self.rooms = set()
         self.room_order = []
-        self.control_flags = ControlFlags(0)
-        self.collection_flags = CollectionFlags(0)
-        self.state_change_flags = StateChangeFlags(0)
+        self.control = 0
+        self.collection = 0
+        self.state_change = 0
         self.mark_flags = 0
 
         self.flag_changes = FlagSet()
@@ -263,40 +731,93 @@ class StateSequence():
     def add_state(self, state):
         raise NotImplementedError
 
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        """
+        Array version of add_state, for segmenting whole tables quickly.
+        Returns (starts, stops, done, extra) for every sequence that feeding
+        the packets [start, stop) of table to add_state would make, valid or
+        not. The sequences hold the packets [starts, stops), done is their
+        done attribute and extra is passed on to _restore. Finished
+        sequences valid() rejects can be left out, like single packets,
+        which none of the classes here accept. Only used for classes that
+        don't override add_state (see _segmenter).
+        """
+        raise NotImplementedError
+
+    def _restore(self, extra):
+        #add_state state that isn't derived from the states themselves
+        pass
+
+    @property
+    def death_state(self):
+        if self.death_state_index < 0:
+            return None
+        return self.states[self.death_state_index]
+
+    def row_range(self):
+        """
+        The [start, stop) table rows of the states
+        """
+        if isinstance(self.states, StateList):
+            return self.states.start, self.states.stop
+        return self.states[0].index, self.states[-1].index+1
+
     def _add_state(self, state):
+        if not isinstance(self.states, list):
+            self.states = list(self.states)
         self.states.append(state)
+        self.length = None
         self.rooms.add(state.room)
         if len(self.room_order) == 0 or self.room_order[-1] != state.room:
             self.room_order.append(state.room)
-        self.control_flags |= state.control_flags
-        self.collection_flags |= state.collection_flags
-        self.state_change_flags |= state.state_change_flags
+        self.control |= state.control
+        self.collection |= state.collection
+        self.state_change |= state.state_change
         self.mark_flags |= state.mark_flags
-        if self.death_state is None and ControlFlags.dead in state.control_flags:
-            self.death_state = state
+        if self.death_state_index < 0 and state.control & CONTROL_DEAD:
             self.death_state_index = len(self.states)-1
 
-        def _inc(data, key):
-            if not key in data.keys():
-                data[key] = 1
-            else:
-                data[key] += 1
-
         for flag_name, flag_state in state.flag_changes:
             self.flag_changes.add_flag(flag_name, flag_state)
 
     def get_duration(self):
+        if isinstance(self.states, StateList):
+            return float(self.states.table.paths().duration(*self.row_range()))
         return self.states[-1].timestamp - self.states[0].timestamp
 
     def get_length(self):
+        """
+        Sum of the squared distance of each step, which weights long
+        movements far more than path length does
+        """
         if self.length is not None: return self.length
 
+        if isinstance(self.states, StateList):
+            self.length = float(self.states.table.paths().squared_length(*self.row_range()))
+            return self.length
+
+        #squares as products, python's ** 2 isn't always correctly rounded
         self.length = 0
         for a,b in zip(self.states[:-1], self.states[1:]):
-            self.length += (a.xpos-b.xpos)**2 + (a.ypos-b.ypos)**2
+            dx, dy = b.xpos-a.xpos, b.ypos-a.ypos
+            self.length += dx*dx + dy*dy
 
         return self.length
 
+    def get_path_length(self):
+        """
+        Distance travelled over the sequence
+        """
+        if isinstance(self.states, StateList):
+            return float(self.states.table.paths().path_length(*self.row_range()))
+
+        result = 0
+        for a,b in zip(self.states[:-1], self.states[1:]):
+            dx, dy = b.xpos-a.xpos, b.ypos-a.ypos
+            result += math.sqrt(dx*dx + dy*dy)
+        return result
+
     def plot(self, ax):
         xvals = []
         yvals = []
@@ -330,11 +851,22 @@ class Run(StateSequence):
     def add_state(self, state):
         if self.done: return
 
-        if ControlFlags.dead in state.control_flags:
+        if state.control & CONTROL_DEAD:
             self.done = True
 
         self._add_state(state)
 
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        #every dead packet ends a run
+        stops = np.flatnonzero(table.control_flags[start:stop] & CONTROL_DEAD)+start+1
+        done = np.ones(len(stops), bool)
+        if stop > start and (len(stops) == 0 or stops[-1] < stop):
+            stops = np.append(stops, stop)
+            done = np.append(done, False)
+        starts = np.concatenate([[start], stops[:-1]])
+        return segment_arrays(starts[:len(stops)], stops, done, np.zeros(len(stops), bool))
+
     def __str__(self):
         return self.states[0].deaths
 
@@ -345,13 +877,60 @@ class RoomRun(Run):
             self.done = True
         elif len(self.states) > 0 and self.states[-1].deaths != state.deaths:
             self.done = True
-            self.control_flags |= ControlFlags.dead
+            self.control |= CONTROL_DEAD
         else:
             super().add_state(state)
 
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        #a run ends at a dead packet, or just before a packet that changes
+        #room or death count, which is dropped. A change on the first packet
+        #of a run is ignored, so of several changing packets in a row every
+        #other one ends a run. extra is set when a death count change ended
+        #the run.
+        dead = (table.control_flags[start:stop] & CONTROL_DEAD) != 0
+        room = table.room_code[start:stop]
+        deaths = table.deaths[start:stop]
+        room_change = np.concatenate([[False], room[1:] != room[:-1]])
+        death_change = np.concatenate([[False], deaths[1:] != deaths[:-1]])
+        change = (room_change | death_change) & ~dead
+
+        #a change ends a run unless the packet before ended one
+        rows = np.arange(len(change))
+        first = change & ~np.concatenate([[False], change[:-1]])
+        first_row = np.maximum.accumulate(np.where(first, rows, 0))
+        before = np.concatenate([[True], dead[:-1]])[first_row]
+        ends = dead | (change & (((rows-first_row)%2 == 0) != before))
+
+        rows = np.flatnonzero(ends)
+        starts = np.concatenate([[0], rows+1])
+        dropped = (room_change | death_change)[rows] & (rows != starts[:-1])
+        stops = np.where(dropped, rows, rows+1)
+        extra = dropped & death_change[rows] & ~room_change[rows]
+        done = np.ones(len(rows), bool)
+        if starts[-1] < len(change):
+            stops = np.append(stops, len(change))
+            done = np.append(done, False)
+            extra = np.append(extra, False)
+        return segment_arrays(starts[:len(stops)]+start, stops+start, done, extra)
+
+    def _restore(self, extra):
+        if extra:
+            self.control |= CONTROL_DEAD
+
 class RoomCompleteRun(RoomRun):
 
     def valid(self):
-        return super().valid() and not ControlFlags.dead in self.control_flags
+        return super().valid() and not self.control & CONTROL_DEAD
+
+    @classmethod
+    def segment_rows(cls, table, start, stop):
+        #most room runs end in a death, leave those out up front
+        starts, stops, done, extra = super().segment_rows(table, start, stop)
+        dead = extra.copy()
+        if len(starts) > 0:
+            dead |= reduce_ranges(table.control_flags, starts, stops) & CONTROL_DEAD != 0
+        keep = ~dead | ~done
+        return starts[keep], stops[keep], done[keep], extra[keep]
 
 